@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+"""Compare the speed and memory use of depgraph's graph implementations.
+
+Builds a random package dependency graph of the given size with both
+depgraph.Graph and depgraph.CompactGraph and runs the same operations that
+depgraph.py's main() does on each.
+
+This script requires Python 3.
+"""
+
+import argparse
+import random
+import time
+import tracemalloc
+
+import depgraph
+
+
+def random_packages(n_packages, n_requires, n_extras, seed=0):
+    """Make up a list of package records like the ones in blockers.json."""
+    rng = random.Random(seed)
+    names = ['package{:06d}'.format(n) for n in range(n_packages)]
+    packages = []
+    for name in names:
+        packages.append({
+            'name': name,
+            'supports_py3': rng.random() < 0.7,
+            'requires': rng.sample(names, n_requires),
+            'requires_extras': {
+                'test': rng.sample(names, n_extras),
+                'docs': [rng.choice(names) + '[test]'],
+            },
+        })
+    return packages
+
+
+def exercise(graph_class, packages):
+    """Do what depgraph.py --extras --why does, more or less."""
+    deps = depgraph.package_graph(packages, False, graph_class)
+    deps.remove_edges_to('setuptools')
+    include = {node for node in deps.nodes if deps.edges(node)}
+    for node in deps.ghost_nodes:
+        deps.add_node(node)
+    include = deps.transitive_closure(include)
+    why = packages[len(packages) // 2]['name']
+    rdeps = deps.transposed()
+    highlight = set(rdeps.traverse(why))
+    highlight_edges = set(rdeps.traverse_edges(why))
+    n_edges = 0
+    for node in deps.nodes:
+        if node not in include:
+            continue
+        deps.node_attrs(node).get('supports_py3')
+        for edge in deps.edges(node):
+            deps.edge_attrs(node, edge).get('extra')
+            n_edges += 1
+    return deps, len(include), len(highlight), len(highlight_edges), n_edges
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-n', '--packages', metavar='N', type=int,
+                        default=20000, help='number of packages')
+    parser.add_argument('--requires', metavar='N', type=int, default=8,
+                        help='number of requirements per package')
+    parser.add_argument('--extras', metavar='N', type=int, default=4,
+                        help='number of test extra requirements per package')
+    args = parser.parse_args()
+
+    packages = random_packages(args.packages, args.requires, args.extras)
+    results = []
+    for graph_class in (depgraph.Graph, depgraph.CompactGraph):
+        start = time.perf_counter()
+        deps, *counts = exercise(graph_class, packages)
+        elapsed = time.perf_counter() - start
+        del deps
+        # tracemalloc slows things down a lot, so measure memory separately
+        tracemalloc.start()
+        deps, *counts = exercise(graph_class, packages)
+        # the graph is still alive, so this is what it costs to keep it
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del deps
+        results.append(counts)
+        print('{:<14} {:8.2f} s {:10.1f} MiB'.format(
+            graph_class.__name__, elapsed, memory / 2**20))
+    if results[0] != results[1]:
+        print('Results differ! {} != {}'.format(*results))
+
+
+if __name__ == '__main__':
+    main()
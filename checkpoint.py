@@ -0,0 +1,98 @@
+"""Crash-resumable progress for the long-running filter scripts.
+
+get_pypi_status.py and get_deps.py process hundreds of packages and take
+minutes.  They append every finished package record to a journal, so a run
+that dies halfway through can be resumed with --resume instead of starting
+over, and they replace their output files atomically, so nobody ever sees
+a truncated JSON file.
+
+This module requires Python 3.
+"""
+
+import json
+import os
+import tempfile
+
+
+def dump_pretty_json_atomically(data, filename):
+    """Dump pretty-printed JSON data to a file, replacing it atomically.
+
+    Readers of the file see either the old version or the new one, never
+    a partially written file.
+    """
+    dirname = os.path.dirname(os.path.abspath(filename))
+    with tempfile.NamedTemporaryFile('w', dir=dirname, delete=False,
+                                     prefix='.tmp-') as f:
+        try:
+            json.dump(data, f, sort_keys=True, indent=2,
+                      separators=(',', ': '))
+            f.flush()
+            os.fsync(f.fileno())
+            # NamedTemporaryFile creates files readable only by the owner
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(f.name, 0o666 & ~umask)
+        except BaseException:
+            os.unlink(f.name)
+            raise
+    os.replace(f.name, filename)
+
+
+class Journal(object):
+    """An append-only journal of finished package records.
+
+    The journal is a text file with one JSON-encoded package record per
+    line.  Every record is flushed as soon as it's added, so it survives
+    the process getting killed.  If a package is recorded more than once,
+    the last record wins.
+
+    If resume is true, records from an existing journal are loaded and new
+    records are appended to it; otherwise the journal starts empty.
+    """
+
+    def __init__(self, filename, resume=False):
+        self.filename = filename
+        self.records = {}
+        if resume and os.path.exists(filename):
+            self.records = self._load()
+        self._f = open(filename, 'a' if resume else 'w')
+        if self._f.tell() > 0:
+            with open(filename, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read() != b'\n':
+                    # don't glue the next record to a truncated one
+                    self._f.write('\n')
+
+    def _load(self):
+        records = {}
+        with open(self.filename) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last line may be cut short by a crash
+                    continue
+                records[record['name']] = record
+        return records
+
+    def __contains__(self, package_name):
+        return package_name in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, package_name):
+        """Return the recorded record of a package."""
+        return self.records[package_name]
+
+    def add(self, record):
+        """Record a finished package record."""
+        self.records[record['name']] = record
+        self._f.write(json.dumps(record, sort_keys=True) + '\n')
+        self._f.flush()
+
+    def close(self, remove=False):
+        """Close the journal, and remove it if the run is complete."""
+        self._f.close()
+        if remove:
+            os.unlink(self.filename)
@@ -1,7 +1,8 @@
 #!/usr/bin/python3
-"""Determine direct blockers for Python 3 support for a package.
+"""Determine blockers for Python 3 support for a package.
 
-Blockers are required packages that do not support Python 3 yet.
+Blockers are required packages that do not support Python 3 yet.  Transitive
+blockers are blockers of blockers, and so on.
 
 Acts as a filter: reads a JSON list of package records ::
 
@@ -15,7 +16,19 @@ and produces an annotated JSON list ::
     "requires": ["setuptools"],
     "supports": ["2.6", "2.7", "3.2", "3.3"],
     "supports_py3": true,
-    "blockers": []}, ...]
+    "blockers": [],
+    "transitive_blockers": [],
+    "transitive_blocks_count": 0,
+    "porting_level": 0,
+    "critical_path": [],
+    "blocker_cycle": []}, ...]
+
+The porting level of a package that supports Python 3 is 0; a package that
+has no blockers is at level 1 (it could be ported right away), a package
+whose blockers are all at level 1 is at level 2, and so on.  The critical
+path is the longest chain of blockers that decides the porting level.
+Packages that block each other in a cycle have to be ported together, so
+they share a level and are listed in each other's blocker_cycle.
 
 This script requires Python 3.
 """
@@ -23,6 +36,7 @@ This script requires Python 3.
 import argparse
 import json
 import sys
+from collections import Counter, deque
 
 
 def dump_pretty_json(data, fp=sys.stdout):
@@ -30,6 +44,260 @@ def dump_pretty_json(data, fp=sys.stdout):
     json.dump(data, fp, sort_keys=True, indent=2, separators=(',', ': '))
 
 
+def strongly_connected_components(nodes, successors):
+    """Find the strongly connected components of a directed graph.
+
+    This is Tarjan's algorithm, with an explicit stack instead of recursion,
+    so long dependency chains cannot hit the recursion limit.
+
+    ``successors`` is a function that returns the successors of a node.
+
+    Returns a list of sorted lists of nodes.  A component comes after all
+    the components reachable from it.
+
+        >>> graph = {'a': ['b'], 'b': ['c'], 'c': ['b', 'd'], 'd': []}
+        >>> strongly_connected_components(sorted(graph), graph.get)
+        [['d'], ['b', 'c'], ['a']]
+
+    """
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    components = []
+    for root in nodes:
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(successors(root)))]
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if child not in index:
+                    index[child] = lowlink[child] = len(index)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(successors(child))))
+                    break
+                elif child in on_stack:
+                    lowlink[node] = min(lowlink[node], index[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(sorted(component))
+    return components
+
+
+class ReachabilityIndex(object):
+    """Precomputed transitive requirements of every package, both ways.
+
+    Nodes are numbered in sorted name order, and the set of packages that
+    a package requires (or is required by), directly or indirectly, is kept
+    as a Python integer with one bit per node.  Questions like "how many
+    packages are downstream of X" or "what do X and Y both depend on" then
+    take a couple of bit operations instead of a graph traversal.
+
+    Build one with ReachabilityIndex.build(), save it with save() and load
+    it back with ReachabilityIndex.load().
+    """
+
+    def __init__(self, nodes, requires, required_by):
+        self.nodes = nodes
+        self.position = {name: n for n, name in enumerate(nodes)}
+        self.requires = requires
+        self.required_by = required_by
+
+    @classmethod
+    def build(cls, graph):
+        """Build the index of a graph.
+
+        ``graph`` maps package names to lists of required package names.
+        """
+        nodes = sorted(set(graph).union(*graph.values()))
+        reverse = {}
+        for src, dsts in graph.items():
+            for dst in dsts:
+                reverse.setdefault(dst, []).append(src)
+        return cls(nodes, cls._reachable(nodes, graph),
+                   cls._reachable(nodes, reverse))
+
+    @staticmethod
+    def _reachable(nodes, graph):
+        position = {name: n for n, name in enumerate(nodes)}
+
+        def successors(name):
+            return graph.get(name, ())
+
+        reachable = [0] * len(nodes)
+        # Components come out after everything they can reach, so the
+        # bitsets of the successors are always ready when we need them.
+        for component in strongly_connected_components(nodes, successors):
+            bits = 0
+            for name in component:
+                for dst in successors(name):
+                    n = position[dst]
+                    bits |= reachable[n] | (1 << n)
+            # every member of a cycle reaches every other member, and so
+            # they all end up in bits
+            for name in component:
+                reachable[position[name]] = bits
+        return reachable
+
+    def _names(self, bits):
+        names = []
+        while bits:
+            lowest = bits & -bits
+            names.append(self.nodes[lowest.bit_length() - 1])
+            bits ^= lowest
+        return names
+
+    def _without_self(self, bitsets, name):
+        n = self.position[name]
+        return bitsets[n] & ~(1 << n)
+
+    def dependencies(self, name):
+        """List the packages that a package requires, directly or not."""
+        return self._names(self._without_self(self.requires, name))
+
+    def dependents(self, name):
+        """List the packages that require a package, directly or not."""
+        return self._names(self._without_self(self.required_by, name))
+
+    def count_dependents(self, name):
+        """Count the packages that require a package, directly or not."""
+        return bin(self._without_self(self.required_by, name)).count('1')
+
+    def common_dependents(self, *names):
+        """List the packages that require all of the given packages."""
+        bits = -1
+        for name in names:
+            bits &= self._without_self(self.required_by, name)
+        return self._names(bits) if names else []
+
+    def save(self, filename):
+        """Save the index to a JSON file."""
+        with open(filename, 'w') as f:
+            json.dump({'nodes': self.nodes,
+                       'requires': ['%x' % bits for bits in self.requires],
+                       'required_by': ['%x' % bits
+                                       for bits in self.required_by]}, f)
+
+    @classmethod
+    def load(cls, filename):
+        """Load an index saved by save()."""
+        with open(filename) as f:
+            data = json.load(f)
+        return cls(data['nodes'],
+                   [int(bits, 16) for bits in data['requires']],
+                   [int(bits, 16) for bits in data['required_by']])
+
+
+def add_transitive_blockers(packages):
+    """Annotate package records with transitive blocker information.
+
+    Expects every package record to have 'supports_py3' and 'blockers'
+    already.  Adds 'transitive_blockers', 'transitive_blocks_count',
+    'porting_level', 'critical_path' and 'blocker_cycle'.
+
+    Dependency cycles are collapsed into single units first, and then every
+    unit is processed once, after all of its blockers, so levels and
+    critical paths take time proportional to the number of packages and
+    blocker relationships.  The transitive blocker set of a unit is the
+    union of the sets of the units it is directly blocked by, so building
+    those takes up to (number of units) x (number of packages) steps for
+    densely connected graphs.
+    """
+    blockers = {info['name']: sorted(set(info['blockers']))
+                for info in packages if not info['supports_py3']}
+    components = strongly_connected_components(sorted(blockers),
+                                               blockers.get)
+    component_of = {}
+    for n, component in enumerate(components):
+        for name in component:
+            component_of[name] = n
+    reachable = []
+    level = []
+    exit_edge = []
+    cyclic = []
+    for n, component in enumerate(components):
+        # Blocker components always come before the components they block
+        linked = set()
+        best = None
+        for name in component:
+            for blocker in blockers[name]:
+                m = component_of[blocker]
+                if m == n:
+                    continue
+                linked.add(m)
+                if (best is None or level[m] > best[0]
+                        or level[m] == best[0] and blocker < best[2]):
+                    best = (level[m], name, blocker)
+        names = set()
+        for m in linked:
+            names.update(components[m])
+            names.update(reachable[m])
+        cyclic.append(len(component) > 1 or
+                      component[0] in blockers[component[0]])
+        if cyclic[-1]:
+            names.update(component)
+        reachable.append(names)
+        level.append(best[0] + 1 if best else 1)
+        exit_edge.append(best[1:] if best else None)
+
+    def path_within_component(src, dst):
+        # Breadth-first search along blocker relationships inside the cycle
+        # that src and dst belong to; returns the path without src.
+        n = component_of[src]
+        predecessor = {src: None}
+        queue = deque([src])
+        while dst not in predecessor:
+            name = queue.popleft()
+            for blocker in blockers[name]:
+                if component_of[blocker] == n and blocker not in predecessor:
+                    predecessor[blocker] = name
+                    queue.append(blocker)
+        path = []
+        while dst != src:
+            path.append(dst)
+            dst = predecessor[dst]
+        path.reverse()
+        return path
+
+    for info in packages:
+        package_name = info['name']
+        if info['supports_py3']:
+            info['transitive_blockers'] = []
+            info['porting_level'] = 0
+            info['critical_path'] = []
+            info['blocker_cycle'] = []
+            continue
+        n = component_of[package_name]
+        info['transitive_blockers'] = sorted(reachable[n] - {package_name})
+        info['porting_level'] = level[n]
+        info['critical_path'] = path = [package_name]
+        while exit_edge[component_of[path[-1]]] is not None:
+            member, blocker = exit_edge[component_of[path[-1]]]
+            path += path_within_component(path[-1], member)
+            path.append(blocker)
+        info['blocker_cycle'] = components[n] if cyclic[n] else []
+    blocks_count = Counter(blocker for info in packages
+                           for blocker in info['transitive_blockers'])
+    for info in packages:
+        info['transitive_blocks_count'] = blocks_count[info['name']]
+
+
 class ArgFormatter(argparse.ArgumentDefaultsHelpFormatter,
                    argparse.RawDescriptionHelpFormatter):
 
@@ -49,6 +317,9 @@ def main():
     parser = argparse.ArgumentParser(
         description=__doc__,
         formatter_class=ArgFormatter)
+    parser.add_argument('--reachability-index', metavar='FILE',
+                        help='also save a reachability index of package'
+                             ' requirements to FILE (see ReachabilityIndex)')
     args = parser.parse_args()
 
     if sys.stdin.isatty():
@@ -93,6 +364,11 @@ def main():
             package_by_name[blocker]['blocks_extras'].append(info['name'])
         for blocker in info['all_blockers']:
             package_by_name[blocker]['blocks_all'].append(info['name'])
+    add_transitive_blockers(packages)
+    if args.reachability_index:
+        ReachabilityIndex.build({
+            info['name']: info.get('requires') or [] for info in packages
+        }).save(args.reachability_index)
     dump_pretty_json(packages)
 
 
@@ -19,7 +19,11 @@ This script requires Python 3.
 import argparse
 import json
 import sys
-from collections import defaultdict
+from array import array
+from collections import deque
+from itertools import chain
+
+from count_blockers import strongly_connected_components
 
 
 class ArgFormatter(argparse.ArgumentDefaultsHelpFormatter,
@@ -86,111 +90,580 @@ class GraphGenerator(object):
                                   for k, v in sorted(attrs.items()))
 
 
+def walk(start, successors, max_depth=None, predecessors=None,
+         breadth_first=False):
+    """Walk a graph from a starting node, without recursion.
+
+    ``successors`` is a function that returns the successors of a node.
+
+    Yields a tuple (src, dst, first) for every edge that is followed, where
+    first is True if that's how dst was reached for the first time.  The
+    order is the same as a recursive depth-first search would produce, or
+    breadth-first if you ask for it.
+
+    Nodes more than max_depth edges away from start are not visited, even
+    if a depth-first walk happens to reach them by a longer path first.
+
+    If you pass a dict as predecessors, it gets filled with the node that
+    each visited node was first reached from (None for start), so you can
+    reconstruct paths with path_to().  These are the shortest paths if you
+    walk breadth-first.
+    """
+    if predecessors is not None:
+        predecessors[start] = None
+    visited = {start}
+    if max_depth is not None and max_depth <= 0:
+        return
+    if breadth_first:
+        queue = deque([(start, 0)])
+        while queue:
+            src, depth = queue.popleft()
+            for dst in successors(src):
+                first = dst not in visited
+                if first:
+                    visited.add(dst)
+                    if predecessors is not None:
+                        predecessors[dst] = src
+                    if max_depth is None or depth + 1 < max_depth:
+                        queue.append((dst, depth + 1))
+                yield src, dst, first
+    else:
+        # With a depth limit a node may first be reached by a long path and
+        # later by a shorter one, which leaves more depth to go further;
+        # such nodes are expanded again (without reporting their edges
+        # twice).
+        depths = {start: 0}
+        expanded = {start}
+        stack = [(start, iter(successors(start)), True)]
+        while stack:
+            src, dsts, report = stack[-1]
+            depth = len(stack)
+            for dst in dsts:
+                first = dst not in visited
+                if first:
+                    visited.add(dst)
+                    if predecessors is not None:
+                        predecessors[dst] = src
+                if report:
+                    yield src, dst, first
+                if max_depth is None:
+                    expand = first
+                else:
+                    expand = depth < depths.get(dst, max_depth)
+                    if expand:
+                        depths[dst] = depth
+                if expand:
+                    stack.append((dst, iter(successors(dst)),
+                                  dst not in expanded))
+                    expanded.add(dst)
+                    break
+            else:
+                stack.pop()
+
+
+def path_to(predecessors, node):
+    """Reconstruct the path to a node from a predecessor map.
+
+        >>> path_to({'a': None, 'b': 'a', 'c': 'b'}, 'c')
+        ['a', 'b', 'c']
+
+    """
+    path = [node]
+    while predecessors[path[-1]] is not None:
+        path.append(predecessors[path[-1]])
+    path.reverse()
+    return path
+
+
+class GraphState(object):
+    """The parts of a Graph that are shared with its transposed views."""
+
+    def __init__(self):
+        self.version = 0
+        self.ghost_nodes = set()
+
+
 class Graph(object):
+    """A directed graph with node and edge attributes.
+
+    Sorted views (nodes, ghost_nodes, edges(src)) are computed once and
+    then remembered until the graph changes; every change bumps
+    self.version.  Don't modify the lists you get from them.
+
+    Edges are indexed in both directions, so transposed() can return a
+    view of the same graph instead of a copy.
+    """
 
     def __init__(self):
-        self._nodes = defaultdict(dict)
-        self._edges = defaultdict(lambda: defaultdict(dict))
-        self._ghost_nodes = set()
+        self._nodes = {}
+        self._edges = {}
+        self._redges = {}
+        self._state = GraphState()
+        self._cache = {}
+
+    @property
+    def version(self):
+        return self._state.version
+
+    def _changed(self):
+        self._state.version += 1
+
+    def _cached(self, key, compute):
+        version, value = self._cache.get(key, (None, None))
+        if version != self._state.version:
+            value = compute()
+            self._cache[key] = (self._state.version, value)
+        return value
+
+    def __contains__(self, name):
+        return name in self._nodes
 
     @property
     def nodes(self):
-        return sorted(self._nodes)
+        return self._cached('nodes', lambda: sorted(self._nodes))
 
     @property
     def ghost_nodes(self):
-        return sorted(self._ghost_nodes)
+        return self._cached('ghost_nodes',
+                            lambda: sorted(self._state.ghost_nodes))
 
     def node_attrs(self, src):
-        return self._nodes[src]
+        return self._nodes.get(src, {})
 
     def edges(self, src):
-        return sorted(self._edges[src])
+        return self._cached(('edges', src),
+                            lambda: sorted(self._edges.get(src, ())))
 
     def has_edge(self, src, dst):
-        return dst in self._edges[src]
+        return dst in self._edges.get(src, ())
 
     def edge_attrs(self, src, dst):
-        return self._edges[src][dst]
+        return self._edges.get(src, {}).get(dst, {})
 
     def transposed(self):
-        other = Graph()
-        for node, attrs in self._nodes.items():
-            other.add_node(node, **attrs)
-        for src, edges in self._edges.items():
-            for dst, attrs in edges.items():
-                other.add_edge(dst, src, **attrs)
+        """Return a view of this graph with all the edges reversed.
+
+        The view shares everything with this graph, so changes made to one
+        show up in the other.
+        """
+        other = Graph.__new__(Graph)
+        other._nodes = self._nodes
+        other._edges = self._redges
+        other._redges = self._edges
+        other._state = self._state
+        other._cache = {}
         return other
 
     def add_node(self, name, **attrs):
-        self._nodes[name].update(attrs)
-        self._ghost_nodes.discard(name)
+        self._nodes.setdefault(name, {}).update(attrs)
+        self._state.ghost_nodes.discard(name)
+        self._changed()
 
     def add_edge(self, src, dst, **attrs):
-        self._edges[src][dst].update(attrs)
+        edge_attrs = self._edges.setdefault(src, {}).get(dst)
+        if edge_attrs is None:
+            # both directions share the same attribute dict
+            edge_attrs = self._edges[src][dst] = {}
+            self._redges.setdefault(dst, {})[src] = edge_attrs
+        edge_attrs.update(attrs)
         if src not in self._nodes:
-            self._ghost_nodes.add(src)
+            self._state.ghost_nodes.add(src)
         if dst not in self._nodes:
-            self._ghost_nodes.add(dst)
+            self._state.ghost_nodes.add(dst)
+        self._changed()
 
     def remove_edges_to(self, dst):
-        for src, edges in self._edges.items():
-            if dst in edges:
-                del edges[dst]
+        for src in self._redges.pop(dst, {}):
+            del self._edges[src][dst]
         if dst not in self._edges:
-            self._ghost_nodes.discard(dst)
+            self._state.ghost_nodes.discard(dst)
+        self._changed()
 
     def remove_edges_with_attr(self, attr):
         for src, edges in self._edges.items():
             for dst, attrs in list(edges.items()):
                 if attrs.get(attr):
                     del edges[dst]
+                    del self._redges[dst][src]
         self._update_ghost_nodes()
+        self._changed()
 
     def _update_ghost_nodes(self):
-        self._ghost_nodes = set(self._edges)
+        ghost_nodes = self._state.ghost_nodes
+        ghost_nodes.clear()
+        ghost_nodes.update(self._edges)
         for src, edges in self._edges.items():
-            self._ghost_nodes.update(edges)
-        self._ghost_nodes.difference_update(self._nodes)
+            ghost_nodes.update(edges)
+        ghost_nodes.difference_update(self._nodes)
+
+    def _successors(self, src):
+        return self._edges.get(src, ())
 
-    def traverse(self, src, visited=None):
-        if visited is None:
-            visited = set([src])
+    def traverse(self, src, max_depth=None, predecessors=None,
+                 breadth_first=False):
+        """Iterate over all nodes reachable from src (see walk())."""
         yield src
-        for dst in self._edges[src]:
-            if dst not in visited:
-                visited.add(dst)
-                for node in self.traverse(dst, visited):
-                    yield node
-
-    def traverse_edges(self, src, visited=None):
-        if visited is None:
-            visited = set([src])
-        for dst in self._edges[src]:
+        for _, dst, first in walk(src, self._successors, max_depth,
+                                  predecessors, breadth_first):
+            if first:
+                yield dst
+
+    def traverse_edges(self, src, max_depth=None, predecessors=None,
+                       breadth_first=False):
+        """Iterate over all edges reachable from src (see walk())."""
+        for src, dst, _ in walk(src, self._successors, max_depth,
+                                predecessors, breadth_first):
             yield (src, dst)
-            if dst not in visited:
-                visited.add(dst)
-                for edge in self.traverse_edges(dst, visited):
-                    yield edge
 
     def transitive_closure(self, nodes):
         closure = set(nodes)
         queue = list(nodes)
         while queue:
             src = queue.pop()
-            for dst in self._edges[src]:
+            for dst in self._edges.get(src, ()):
                 if dst not in closure:
                     closure.add(dst)
                     queue.append(dst)
         return closure
 
 
+class CompactGraph(object):
+    """A graph with the same interface as Graph that needs much less memory.
+
+    Node names are interned as integer ids, edges are kept in parallel
+    arrays with edge attributes stored as small integer columns, and
+    adjacency lists are built on demand as compressed sparse rows (one
+    array of row offsets and one array of edge numbers), in both directions.
+    Any change to the edges throws the rows away; they're rebuilt the next
+    time somebody looks at the edges.
+
+    Only the node and edge attributes that package_graph() uses are
+    supported: 'supports_py3' for nodes, 'extra' and 'tight' for edges.
+    """
+
+    # values of the supports_py3 column
+    MISSING = -2
+    NONE = -1
+
+    # edge flags
+    TIGHT = 1
+    REMOVED = 2
+
+    def __init__(self):
+        self._names = []
+        self._ids = {}
+        self._is_node = bytearray()
+        self._supports_py3 = array('b')
+        self._extras = []
+        self._extra_ids = {}
+        self._src = array('i')
+        self._dst = array('i')
+        self._extra = array('i')
+        self._flags = bytearray()
+        self._edge_numbers = {}
+        self._rows = None
+
+    def _intern(self, name):
+        node_id = self._ids.get(name)
+        if node_id is None:
+            node_id = self._ids[name] = len(self._names)
+            self._names.append(name)
+            self._is_node.append(0)
+            self._supports_py3.append(self.MISSING)
+        return node_id
+
+    def _edge_number(self, src, dst):
+        src_id = self._ids.get(src)
+        dst_id = self._ids.get(dst)
+        if src_id is None or dst_id is None:
+            return None
+        return self._edge_numbers.get((src_id << 32) | dst_id)
+
+    def _build_rows(self, key):
+        """Build compressed sparse rows of the live edges, grouped by key.
+
+        Edges of a row are in the order they were added.
+        """
+        offsets = array('i', [0]) * (len(self._names) + 1)
+        live = [n for n, flags in enumerate(self._flags)
+                if not flags & self.REMOVED]
+        for n in live:
+            offsets[key[n] + 1] += 1
+        for node_id in range(len(self._names)):
+            offsets[node_id + 1] += offsets[node_id]
+        cursor = array('i', offsets)
+        edges = array('i', [0]) * len(live)
+        for n in live:
+            edges[cursor[key[n]]] = n
+            cursor[key[n]] += 1
+        return offsets, edges
+
+    def _out_edges(self, node_id):
+        """Return the numbers of the edges that start at a node."""
+        if self._rows is None:
+            self._rows = (self._build_rows(self._src),
+                          self._build_rows(self._dst))
+        offsets, edges = self._rows[0]
+        return edges[offsets[node_id]:offsets[node_id + 1]]
+
+    def _in_edges(self, node_id):
+        """Return the numbers of the edges that end at a node."""
+        self._out_edges(node_id)
+        offsets, edges = self._rows[1]
+        return edges[offsets[node_id]:offsets[node_id + 1]]
+
+    def _successors(self, node_id):
+        dst = self._dst
+        return [dst[n] for n in self._out_edges(node_id)]
+
+    def __contains__(self, name):
+        node_id = self._ids.get(name)
+        return node_id is not None and bool(self._is_node[node_id])
+
+    @property
+    def nodes(self):
+        return sorted(name for name, is_node in zip(self._names, self._is_node)
+                      if is_node)
+
+    @property
+    def ghost_nodes(self):
+        return sorted(name for node_id, name in enumerate(self._names)
+                      if not self._is_node[node_id] and
+                      (self._out_edges(node_id) or self._in_edges(node_id)))
+
+    def node_attrs(self, src):
+        node_id = self._ids.get(src)
+        if node_id is None or self._supports_py3[node_id] == self.MISSING:
+            return {}
+        supports_py3 = self._supports_py3[node_id]
+        return {'supports_py3':
+                None if supports_py3 == self.NONE else bool(supports_py3)}
+
+    def edges(self, src):
+        node_id = self._ids.get(src)
+        if node_id is None:
+            return []
+        return sorted(self._names[dst_id]
+                      for dst_id in self._successors(node_id))
+
+    def has_edge(self, src, dst):
+        return self._edge_number(src, dst) is not None
+
+    def edge_attrs(self, src, dst):
+        n = self._edge_number(src, dst)
+        if n is None:
+            return {}
+        attrs = {'extra': self._extras[self._extra[n]]
+                 if self._extra[n] >= 0 else None}
+        if self._flags[n] & self.TIGHT:
+            attrs['tight'] = True
+        return attrs
+
+    def transposed(self):
+        other = CompactGraph()
+        other._names = list(self._names)
+        other._ids = dict(self._ids)
+        other._is_node = bytearray(self._is_node)
+        other._supports_py3 = array('b', self._supports_py3)
+        other._extras = list(self._extras)
+        other._extra_ids = dict(self._extra_ids)
+        other._src = array('i', self._dst)
+        other._dst = array('i', self._src)
+        other._extra = array('i', self._extra)
+        other._flags = bytearray(self._flags)
+        other._edge_numbers = {
+            (dst_id << 32) | src_id: n
+            for n, (src_id, dst_id) in enumerate(zip(self._src, self._dst))
+            if not self._flags[n] & self.REMOVED}
+        return other
+
+    def add_node(self, name, **attrs):
+        node_id = self._intern(name)
+        self._is_node[node_id] = 1
+        if 'supports_py3' in attrs:
+            supports_py3 = attrs.pop('supports_py3')
+            self._supports_py3[node_id] = (
+                self.NONE if supports_py3 is None else bool(supports_py3))
+        if attrs:
+            raise TypeError('unsupported node attributes: {}'.format(
+                ', '.join(sorted(attrs))))
+
+    def add_edge(self, src, dst, **attrs):
+        src_id = self._intern(src)
+        dst_id = self._intern(dst)
+        key = (src_id << 32) | dst_id
+        n = self._edge_numbers.get(key)
+        if n is None:
+            n = self._edge_numbers[key] = len(self._src)
+            self._src.append(src_id)
+            self._dst.append(dst_id)
+            self._extra.append(-1)
+            self._flags.append(0)
+            self._rows = None
+        if 'extra' in attrs:
+            extra = attrs.pop('extra')
+            if extra is None:
+                self._extra[n] = -1
+            else:
+                if extra not in self._extra_ids:
+                    self._extra_ids[extra] = len(self._extras)
+                    self._extras.append(extra)
+                self._extra[n] = self._extra_ids[extra]
+        if 'tight' in attrs:
+            if attrs.pop('tight'):
+                self._flags[n] |= self.TIGHT
+            else:
+                self._flags[n] &= ~self.TIGHT
+        if attrs:
+            raise TypeError('unsupported edge attributes: {}'.format(
+                ', '.join(sorted(attrs))))
+
+    def _remove_edge(self, n):
+        self._flags[n] |= self.REMOVED
+        del self._edge_numbers[(self._src[n] << 32) | self._dst[n]]
+        self._rows = None
+
+    def remove_edges_to(self, dst):
+        node_id = self._ids.get(dst)
+        if node_id is None:
+            return
+        for n in self._in_edges(node_id):
+            self._remove_edge(n)
+
+    def remove_edges_with_attr(self, attr):
+        for n in range(len(self._flags)):
+            if self._flags[n] & self.REMOVED:
+                continue
+            if (attr == 'extra' and self._extra[n] >= 0 or
+                    attr == 'tight' and self._flags[n] & self.TIGHT):
+                self._remove_edge(n)
+
+    def _walk(self, src, max_depth, predecessors, breadth_first):
+        """Walk the graph like walk() does, but with node names."""
+        if predecessors is not None:
+            predecessors[src] = None
+        if src not in self._ids:
+            return
+        names = self._names
+        for src_id, dst_id, first in walk(self._ids[src], self._successors,
+                                          max_depth, None, breadth_first):
+            if first and predecessors is not None:
+                predecessors[names[dst_id]] = names[src_id]
+            yield names[src_id], names[dst_id], first
+
+    def traverse(self, src, max_depth=None, predecessors=None,
+                 breadth_first=False):
+        yield src
+        for _, dst, first in self._walk(src, max_depth, predecessors,
+                                        breadth_first):
+            if first:
+                yield dst
+
+    def traverse_edges(self, src, max_depth=None, predecessors=None,
+                       breadth_first=False):
+        for src, dst, _ in self._walk(src, max_depth, predecessors,
+                                      breadth_first):
+            yield (src, dst)
+
+    def transitive_closure(self, nodes):
+        closure = set(nodes)
+        queue = [self._ids[name] for name in closure if name in self._ids]
+        seen = set(queue)
+        while queue:
+            src_id = queue.pop()
+            for dst_id in self._successors(src_id):
+                if dst_id not in seen:
+                    seen.add(dst_id)
+                    closure.add(self._names[dst_id])
+                    queue.append(dst_id)
+        return closure
+
+
+def redundant_edges(edges):
+    """Find the edges of a graph that are implied by other edges.
+
+    An edge from a to c is redundant if there's also a longer path from a
+    to c, e.g. a -> b -> c.  Removing all of them gives the transitive
+    reduction of the graph, which has the same reachability but is much
+    easier to lay out and to look at.
+
+    Packages that depend on each other in a cycle are treated as a single
+    node: edges inside a cycle are all kept, and so are all the edges that
+    together make up a single necessary link between two cycles.
+
+    Returns a set of (src, dst) tuples.
+
+        >>> sorted(redundant_edges([('a', 'b'), ('b', 'c'), ('a', 'c'),
+        ...                         ('c', 'd'), ('d', 'c'), ('d', 'e'),
+        ...                         ('a', 'e')]))
+        [('a', 'c'), ('a', 'e')]
+
+    """
+    successors = {}
+    for src, dst in edges:
+        successors.setdefault(src, []).append(dst)
+    nodes = sorted(set(successors).union(*successors.values()))
+    components = strongly_connected_components(
+        nodes, lambda node: successors.get(node, ()))
+    component_of = {}
+    for n, component in enumerate(components):
+        for node in component:
+            component_of[node] = n
+    # reachable[n] has bit m set if component m can be reached from
+    # component n; components can only reach components that come before
+    # them
+    reachable = []
+    redundant = set()
+    for n, component in enumerate(components):
+        links = {}
+        for src in component:
+            for dst in successors.get(src, ()):
+                if component_of[dst] != n:
+                    links.setdefault(component_of[dst], []).append(
+                        (src, dst))
+        implied = 0
+        for m in links:
+            implied |= reachable[m]
+        for m, link in links.items():
+            if implied >> m & 1:
+                redundant.update(link)
+        reachable.append(implied | sum(1 << m for m in links))
+    return redundant
+
+
 def base_name(name_with_extra):
     return name_with_extra.partition('[')[0]
 
 
-def package_graph(json_data, explicit_extras=False):
-    graph = Graph()
+def extras_closure(graph, nodes):
+    """Compute the transitive closure of nodes, with explicit extras.
+
+    Like graph.transitive_closure(), except that every package that gets
+    included also brings in all of its pkg[extra] nodes (the ones that
+    package_graph() creates with explicit_extras=True), and those bring in
+    their requirements, and so on.  A pkg[extra] brings in pkg through the
+    edge that package_graph() adds between them.
+
+    Returns a set of nodes; names in the nodes argument that are not in the
+    graph are left out.
+    """
+    extras = {}
+    for node in graph.nodes:
+        if '[' in node:
+            extras.setdefault(base_name(node), []).append(node)
+    closure = set(nodes)
+    queue = list(closure)
+    while queue:
+        src = queue.pop()
+        for dst in chain(graph.edges(src), extras.get(src, ())):
+            if dst not in closure:
+                closure.add(dst)
+                queue.append(dst)
+    return {node for node in closure if node in graph}
+
+
+def package_graph(json_data, explicit_extras=False, graph_class=Graph):
+    graph = graph_class()
     for info in json_data:
         src = info['name']
         graph.add_node(src, supports_py3=info['supports_py3'])
@@ -234,8 +707,15 @@ def main():
     parser.add_argument('-l', '--layout', default=argparse.SUPPRESS,
         help='specify graph layout (e.g. dot, neato, twopi, circo, fdp;'
              ' default: dot for --big-nodes, neato otherwise)')
+    parser.add_argument('--compact', action='store_true',
+        help='use a slower graph representation that needs much less memory'
+             ' (for really big graphs)')
     parser.add_argument('-w', '--why', metavar='PACKAGE',
         help='highlight the dependency chain that pulls in PACKAGE')
+    parser.add_argument('--why-depth', metavar='N', type=int,
+        help='highlight only the last N links of the dependency chain')
+    parser.add_argument('--reduce', action='store_true',
+        help='leave out edges implied by other edges (transitive reduction)')
     parser.add_argument('--requiring', metavar='PACKAGE',
         help='show only the dependency chain that pulls in PACKAGE')
     args = parser.parse_args()
@@ -249,14 +729,15 @@ def main():
     else:
         packages = json.load(sys.stdin)
 
-    deps = package_graph(packages, args.explicit_extras)
+    deps = package_graph(packages, args.explicit_extras,
+                         CompactGraph if args.compact else Graph)
     deps.remove_edges_to('setuptools') # because everything depends on it
 
     if getattr(args, 'package_names', None):
         include = set(args.package_names)
         title = "{} deps".format(" ".join(args.package_names))
         for pkg in args.package_names:
-            if pkg not in deps.nodes:
+            if pkg not in deps:
                 print("{}: unknown package: {}".format(parser.prog, pkg),
                       file=sys.stderr)
     else:
@@ -271,13 +752,10 @@ def main():
     for node in deps.ghost_nodes:
         deps.add_node(node)
 
-    include = deps.transitive_closure(include)
-
     if args.explicit_extras:
-        new = {node for node in deps.nodes if base_name(node) in include}
-        while new != include:
-            include = deps.transitive_closure(new)
-            new = {node for node in deps.nodes if base_name(node) in include}
+        include = extras_closure(deps, include)
+    else:
+        include = deps.transitive_closure(include)
 
     if args.requiring:
         rdeps = deps.transposed()
@@ -285,10 +763,15 @@ def main():
 
     highlight = set()
     highlight_edges = set()
+    why = {}
     if args.why:
         rdeps = deps.transposed()
-        highlight = set(rdeps.traverse(args.why))
-        highlight_edges = set(rdeps.traverse_edges(args.why))
+        highlight.add(args.why)
+        # breadth first, so we know the shortest chain for every package
+        for src, dst in rdeps.traverse_edges(args.why, args.why_depth, why,
+                                             breadth_first=True):
+            highlight.add(dst)
+            highlight_edges.add((src, dst))
 
     if args.auto_nodes:
         big_nodes = len(include) < args.auto_threshold
@@ -302,6 +785,23 @@ def main():
     else:
         layout = 'neato'
 
+    def shown_edges(node):
+        for edge in deps.edges(node):
+            # if foo depends on bar[extra], we want to show it depending on bar
+            dest = edge if args.explicit_extras else base_name(edge)
+            if dest in include:
+                yield edge, dest
+
+    redundant = set()
+    if args.reduce:
+        edges = [(node, edge) for node in deps.nodes if node in include
+                 for edge, dest in shown_edges(node)]
+        redundant = {(node, edge) for node, edge in redundant_edges(edges)
+                     if (edge, node) not in highlight_edges}
+        print("{}: removed {} of {} edges".format(
+                  parser.prog, len(redundant), len(edges)),
+              file=sys.stderr)
+
     graph = GraphGenerator()
     graph.start(title)
     graph.options('graph', layout=layout, outputorder="edgesfirst")
@@ -325,11 +825,10 @@ def main():
             attrs['fillcolor'] = "#ffdddd80"
         if node in highlight:
             attrs['color'] = "#ff8c00"
+            attrs['tooltip'] = ' -> '.join(reversed(path_to(why, node)))
         graph.node(node, **attrs)
-        for edge in deps.edges(node):
-            # if foo depends on bar[extra], we want to show it depending on bar
-            dest = edge if args.explicit_extras else base_name(edge)
-            if dest not in include:
+        for edge, dest in shown_edges(node):
+            if (node, edge) in redundant:
                 continue
             attrs = {}
             if not deps.node_attrs(dest).get('supports_py3', True):
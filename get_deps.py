@@ -12,19 +12,55 @@ and produces an annotated JSON list ::
     "requires": ["setuptools"]}, ...]
 
 The information is extracted from setuptools metadata in source
-distributions, which have to be downloaded from the Internet.
+distributions, which have to be downloaded from the Internet.  With
+--requires-dist the requirements listed in PyPI metadata (the "requires_dist"
+key added by get_pypi_status.py) are used instead, when available.  With
+--wheels the requirements are read from the metadata of the wheel named by
+"wheel_url", which needs only a few KB of the wheel.
 
-This script requires Python 3.
+Packages that have no sdist on PyPI but have a "github_web_url" can have
+their requirements read from setup.py, setup.cfg or pyproject.toml in their
+git repositories with --git-mirrors.
+
+This script requires Python 3, and the 'git' command-line tool for
+--git-mirrors.
 """
 
 import argparse
+import ast
+import concurrent.futures
+import configparser
+import contextlib
+import email.parser
+import hashlib
 import json
+import multiprocessing
 import os
+import re
+import shutil
 import sys
 import tarfile
+import time
+import urllib.error
 import zipfile
 from urllib.parse import urlparse
-from urllib.request import urlretrieve
+
+import gitmirror
+import httpclient
+from checkpoint import Journal, dump_pretty_json_atomically
+
+try:
+    import tomllib
+except ImportError:
+    # Python < 3.11; we'll have to make do with setup.py and setup.cfg
+    tomllib = None
+
+
+REQUIREMENTS_INDEX = '.requirements-index.json'
+REQUIREMENTS_INDEX_SCHEMA = 1
+ACCESS_INDEX = '.access-index.json'
+
+SDIST_EXTENSIONS = ('.zip', '.tar.gz', '.tar.bz2', '.tar.xz', '.tar')
 
 
 class Error(Exception):
@@ -46,7 +82,161 @@ def get_cache_filename(sdist_url, cache_dir):
     return os.path.join(cache_dir, basename)
 
 
-def get_local_sdist(sdist_url, cache_dir):
+def sha256sum(filename):
+    """Compute the SHA-256 checksum of a file."""
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(64 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def download(url, filename, sha256=None, pool=None):
+    """Download a URL into a file.
+
+    Streams the data into filename + '.part' and renames that to filename
+    only when it's complete and matches the expected SHA-256 checksum
+    (if given), so filename never refers to a partial download.
+
+    If a .part file is left over from an earlier interrupted download, asks
+    the server for the rest of the file only.
+    """
+    if pool is None:
+        pool = httpclient.default_pool
+    partial = filename + '.part'
+    offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+    headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+    try:
+        with pool.open(url, headers) as r:
+            # Servers that don't support ranges send the whole file
+            resumed = r.status == 206
+            content_range = r.getheader('Content-Range', '')
+            if resumed and not content_range.startswith(
+                    'bytes {}-'.format(offset)):
+                raise Error('Unexpected Content-Range from {}: {}'.format(
+                    url, content_range))
+            with open(partial, 'ab' if resumed else 'wb') as f:
+                shutil.copyfileobj(r, f)
+    except urllib.error.HTTPError as e:
+        # 416 Range Not Satisfiable: the .part file is already complete
+        if not (e.code == 416 and offset):
+            raise
+    if sha256 and sha256sum(partial) != sha256:
+        os.unlink(partial)
+        raise Error('Checksum mismatch for {}'.format(url))
+    os.replace(partial, filename)
+
+
+CONTENT_RANGE = re.compile(r'bytes (\d+)-(\d+)/(\d+)$')
+
+
+class RemoteFile(object):
+    """A read-only file on an HTTP server.
+
+    Implements just enough of the file interface for zipfile: reading and
+    seeking.  Only the parts of the file that are actually read get fetched,
+    with HTTP Range requests of at least block_size bytes.  The first request
+    fetches the end of the file, where a zip file keeps its central
+    directory.
+
+    If the server doesn't support Range requests, the first request gets the
+    whole file, and that is kept in memory.
+    """
+
+    def __init__(self, url, pool=None, block_size=64 * 1024):
+        if pool is None:
+            pool = httpclient.default_pool
+        self.url = url
+        self.pool = pool
+        self.block_size = block_size
+        self.pos = 0
+        self.blocks = []
+        start, data, self.size = self._fetch(
+            'bytes=-{}'.format(block_size))
+        self.blocks.append((start, data))
+
+    def _fetch(self, byte_range):
+        """Fetch a byte range of the file.
+
+        Returns a tuple (start, data, file_size).
+        """
+        with self.pool.open(self.url, {'Range': byte_range}) as r:
+            data = r.read()
+            if r.status != 206:
+                # Servers that don't support ranges send the whole file
+                return 0, data, len(data)
+            content_range = r.getheader('Content-Range', '')
+        match = CONTENT_RANGE.match(content_range)
+        if not match:
+            raise Error('Unexpected Content-Range from {}: {}'.format(
+                self.url, content_range))
+        return int(match.group(1)), data, int(match.group(3))
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError('negative seek position {}'.format(offset))
+        self.pos = offset
+        return self.pos
+
+    def read(self, size=-1):
+        if size < 0 or self.pos + size > self.size:
+            size = max(0, self.size - self.pos)
+        if size == 0:
+            # at or past the end of the file: there's no valid range to ask
+            # for
+            return b''
+        for start, data in self.blocks:
+            if start <= self.pos and self.pos + size <= start + len(data):
+                break
+        else:
+            end = min(self.size, self.pos + max(size, self.block_size))
+            start, data, _ = self._fetch(
+                'bytes={}-{}'.format(self.pos, end - 1))
+            if start != self.pos or len(data) < size:
+                raise Error('Unexpected response for a Range request to {}'
+                            .format(self.url))
+            self.blocks.append((start, data))
+        result = data[self.pos - start:self.pos - start + size]
+        self.pos += len(result)
+        return result
+
+
+def read_wheel_metadata(wheel_url, pool=None):
+    """Read the *.dist-info/METADATA file of a wheel on an HTTP server.
+
+    Fetches only the parts of the wheel that are needed, if the server
+    supports Range requests.
+
+    Returns bytes.
+    """
+    with zipfile.ZipFile(RemoteFile(wheel_url, pool)) as f:
+        for name in f.namelist():
+            if name.count('/') == 1 and name.endswith('.dist-info/METADATA'):
+                return f.read(name)
+    raise Error('No .dist-info/METADATA in {}'.format(wheel_url))
+
+
+def read_wheel_requirements(wheel_url, pool=None):
+    """Read the requirements of a wheel on an HTTP server.
+
+    Returns a tuple (requirements, extras), like parse_requires_dist().
+    """
+    metadata = email.parser.BytesHeaderParser().parsebytes(
+        read_wheel_metadata(wheel_url, pool))
+    return parse_requires_dist(metadata.get_all('Requires-Dist') or [])
+
+
+def get_local_sdist(sdist_url, cache_dir, sha256=None):
     """Return the filename corresponding to a source distribution.
 
     Downloads the file from sdist_url into the cache directory if necessary.
@@ -54,19 +244,31 @@ def get_local_sdist(sdist_url, cache_dir):
     filename = get_cache_filename(sdist_url, cache_dir)
     if not os.path.exists(filename):
         # This would be a good spot for a "Downloading {}" message if verbose
-        urlretrieve(sdist_url, filename)
+        download(sdist_url, filename, sha256)
     return filename
 
 
 def extract_requirements_from_tar(sdist_filename):
     """Extract a file named **/*.egg-info/requires.txt in a .tar[.gz] sdist.
 
+    Reads the archive sequentially, just once, and stops as soon as it finds
+    requires.txt, or a top-level PKG-INFO that lists requirements (which
+    gets converted to the requires.txt format).
+
     Returns bytes or None.
     """
-    with tarfile.open(sdist_filename, 'r') as f:
-        for name in f.getnames():
-            if name.endswith('.egg-info/requires.txt'):
-                return f.extractfile(name).read()
+    # 'r|*' is stream mode: it never seeks back, so the archive doesn't get
+    # decompressed more than once.
+    with tarfile.open(sdist_filename, 'r|*') as f:
+        for member in f:
+            if member.name.endswith('.egg-info/requires.txt'):
+                return f.extractfile(member).read()
+            if member.name.count('/') == 1 and \
+                    member.name.endswith('/PKG-INFO'):
+                requires_txt_data = requires_txt_from_pkg_info(
+                    f.extractfile(member).read())
+                if requires_txt_data is not None:
+                    return requires_txt_data
     return None
 
 
@@ -89,12 +291,159 @@ def extract_requirements(sdist_filename):
     """
     if sdist_filename.endswith('.zip'):
         return extract_requirements_from_zip(sdist_filename)
-    elif sdist_filename.endswith(('.tar.gz', '.tar.bz2', '.tar')):
+    elif sdist_filename.endswith(('.tar.gz', '.tar.bz2', '.tar.xz', '.tar')):
         return extract_requirements_from_tar(sdist_filename)
     else:
         raise Error('Unsupported archive format: {}'.format(sdist_filename))
 
 
+def read_requirements(sdist_filename):
+    """Extract and parse the requirements of an sdist.
+
+    This is a top-level function so it can be run in a worker process.
+
+    Returns a tuple (requirements, extras).
+    """
+    requires_txt_data = extract_requirements(sdist_filename)
+    return parse_requirements(requires_txt_data or b'')
+
+
+class RequirementsIndex(object):
+    """Parsed requirements of the sdists in a cache directory.
+
+    Decompressing hundreds of sdists on every run just to get the same
+    answers as last time is slow.  The index remembers the requirements
+    of every sdist, keyed by its file name, and trusts them as long as the
+    size and modification time of the file stay the same.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self.changed = False
+        try:
+            with open(filename) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('schema') == REQUIREMENTS_INDEX_SCHEMA:
+            self.entries = data['sdists']
+
+    @staticmethod
+    def _identity(sdist_filename):
+        st = os.stat(sdist_filename)
+        return [st.st_size, st.st_mtime_ns]
+
+    def get(self, sdist_filename):
+        """Return remembered (requirements, extras) of an sdist, or None."""
+        entry = self.entries.get(os.path.basename(sdist_filename))
+        if entry is None:
+            return None
+        if entry['identity'] != self._identity(sdist_filename):
+            return None
+        return entry['requires'], entry['requires_extras']
+
+    def put(self, sdist_filename, requirements, extras):
+        """Remember the requirements of an sdist."""
+        self.entries[os.path.basename(sdist_filename)] = {
+            'identity': self._identity(sdist_filename),
+            'requires': requirements,
+            'requires_extras': extras,
+        }
+        self.changed = True
+
+    def discard(self, basename):
+        """Forget the requirements of an sdist that is no longer cached."""
+        if self.entries.pop(basename, None) is not None:
+            self.changed = True
+
+    def save(self):
+        """Write the index back to disk, if it changed."""
+        if self.changed:
+            dump_pretty_json_atomically(
+                {'schema': REQUIREMENTS_INDEX_SCHEMA, 'sdists': self.entries},
+                self.filename)
+            self.changed = False
+
+
+class AccessIndex(object):
+    """When each file in a cache directory was last used.
+
+    We can't rely on file access times because most filesystems are mounted
+    with relatime or noatime.  Files that are not in the index are assumed
+    to have been last used when they were last modified.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self.changed = False
+        try:
+            with open(filename) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def touch(self, filename):
+        """Record that a file was used just now."""
+        self.entries[os.path.basename(filename)] = time.time()
+        self.changed = True
+
+    def last_used(self, filename):
+        """Return the time a file was last used."""
+        last_used = self.entries.get(os.path.basename(filename))
+        if last_used is None:
+            last_used = os.path.getmtime(filename)
+        return last_used
+
+    def discard(self, basename):
+        """Forget a file that was removed."""
+        if self.entries.pop(basename, None) is not None:
+            self.changed = True
+
+    def save(self):
+        """Write the index back to disk, if it changed."""
+        if self.changed:
+            dump_pretty_json_atomically(self.entries, self.filename)
+            self.changed = False
+
+
+def evict_from_cache(cache_dir, max_bytes, protected, access_index):
+    """Remove least recently used sdists until the cache fits in max_bytes.
+
+    Only sdists (and their partial downloads) count towards max_bytes, and
+    only they are ever removed; other files in the directory are left
+    alone.  File names listed in protected are never removed.
+
+    Returns a tuple (bytes_reclaimed, removed_file_names).
+    """
+    total = 0
+    candidates = []
+    for entry in os.scandir(cache_dir):
+        if not entry.is_file():
+            continue
+        name = entry.name
+        if name.endswith('.part'):
+            name = name[:-len('.part')]
+        if not name.endswith(SDIST_EXTENSIONS):
+            continue
+        size = entry.stat().st_size
+        total += size
+        if name not in protected:
+            candidates.append(
+                (access_index.last_used(entry.path), entry.path, size))
+    candidates.sort()
+    reclaimed = 0
+    removed = []
+    for last_used, filename, size in candidates:
+        if total - reclaimed <= max_bytes:
+            break
+        os.unlink(filename)
+        reclaimed += size
+        removed.append(os.path.basename(filename))
+    return reclaimed, removed
+
+
 def strip_version_constraints(requirement):
     """Strip version constraints and extras from a requirement.
 
@@ -162,6 +511,281 @@ def parse_requirements(requires_txt_data):
     return requirements, extras
 
 
+EXTRA_MARKER = re.compile(r"""\bextra\s*==\s*(['"])([^'"]*)\1""")
+
+REQUIREMENT_NAME = re.compile(
+    r'\s*([A-Za-z0-9][A-Za-z0-9._-]*)\s*(\[[^\]]*\])?')
+
+
+def split_extra_marker(marker):
+    """Split an environment marker into an extra name and the rest.
+
+        >>> split_extra_marker('')
+        ('', '')
+
+        >>> split_extra_marker('extra == "test"')
+        ('test', '')
+
+        >>> split_extra_marker('python_version < "3"')
+        ('', 'python_version < "3"')
+
+        >>> split_extra_marker("python_version < '3' and extra == 'test'")
+        ('test', "python_version < '3'")
+
+    """
+    match = EXTRA_MARKER.search(marker)
+    if not match:
+        return '', marker.strip()
+    rest = marker[:match.start()] + marker[match.end():]
+    rest = re.sub(r'\(\s*\)', '', rest).strip()
+    rest = re.sub(r'^and\s+|\s+and$', '', rest).strip()
+    return match.group(2), rest
+
+
+def group_requires_dist(requires_dist):
+    """Group a list of Requires-Dist entries the way requires.txt does.
+
+    Returns a dict mapping section names ("", "extra", ":marker" or
+    "extra:marker") to lists of requirements without version constraints.
+    """
+    sections = {}
+    for spec in requires_dist:
+        requirement, _, marker = spec.partition(';')
+        match = REQUIREMENT_NAME.match(requirement)
+        if not match:
+            continue
+        extra, marker = split_extra_marker(marker)
+        if marker:
+            extra += ':' + marker
+        sections.setdefault(extra, []).append(
+            match.group(1) + (match.group(2) or ''))
+    return sections
+
+
+def requires_txt_from_pkg_info(pkg_info_data):
+    """Convert the Requires-Dist headers of a PKG-INFO file to requires.txt.
+
+    Returns bytes, or None if there are no Requires-Dist headers (older
+    versions of setuptools didn't write any).
+
+        >>> print(requires_txt_from_pkg_info(b'''Metadata-Version: 2.1
+        ... Name: zope.foo
+        ... Requires-Dist: zope.interface
+        ... Requires-Dist: zope.testing; extra == "test"
+        ... ''').decode())
+        zope.interface
+        <BLANKLINE>
+        [test]
+        zope.testing
+        <BLANKLINE>
+
+    """
+    msg = email.parser.BytesHeaderParser().parsebytes(pkg_info_data)
+    requires_dist = msg.get_all('Requires-Dist')
+    if not requires_dist:
+        return None
+    sections = group_requires_dist(requires_dist)
+    lines = sections.pop('', [])
+    for section, requirements in sorted(sections.items()):
+        lines += ['', '[{}]'.format(section)] + requirements
+    return ''.join(line + '\n' for line in lines).encode('UTF-8')
+
+
+def parse_requires_dist(requires_dist):
+    """Parse a list of Requires-Dist entries from package metadata.
+
+    Returns a list of requirements, and a dictionary of extra requirements,
+    in the same format as parse_requirements().  Requirements with
+    environment markers are keyed the way setuptools writes them into
+    requires.txt: "extra", ":marker" or "extra:marker".
+
+    Drops all version constraints.
+
+        >>> requirements, extras = parse_requires_dist([
+        ...     'zope.interface (>=3.6)',
+        ...     'zope.testing ; extra == "test"',
+        ...     'zope.foo[docs] >=1.0, !=1.1',
+        ...     'zope.bar; python_version < "3"'])
+        >>> requirements
+        ['zope.interface', 'zope.foo', 'zope.foo[docs]']
+        >>> extras
+        {'test': ['zope.testing'], ':python_version < "3"': ['zope.bar']}
+
+    """
+    requirements = []
+    extras = {}
+    for section, specs in group_requires_dist(requires_dist).items():
+        cur = extras.setdefault(section, []) if section else requirements
+        for requirement in specs:
+            cur.extend(unroll_extras(requirement))
+    return requirements, extras
+
+
+def requires_dist_from_setuptools(install_requires, extras_require):
+    """Convert setuptools' install_requires and extras_require to a list of
+    Requires-Dist entries.
+
+        >>> for spec in requires_dist_from_setuptools(
+        ...         ['zope.interface'],
+        ...         {'test': ['zope.testing'],
+        ...          'py2:python_version < "3"': ['six']}):
+        ...     print(spec)
+        zope.interface
+        six; python_version < "3" and extra == "py2"
+        zope.testing; extra == "test"
+
+    """
+    if isinstance(install_requires, str):
+        install_requires = install_requires.splitlines()
+    requires_dist = [spec.strip() for spec in install_requires
+                     if spec.strip()]
+    for key, specs in sorted(extras_require.items()):
+        if isinstance(specs, str):
+            specs = specs.splitlines()
+        extra, _, marker = key.partition(':')
+        for spec in specs:
+            requirement, _, spec_marker = spec.partition(';')
+            if not requirement.strip():
+                continue
+            markers = [m.strip() for m in (marker, spec_marker) if m.strip()]
+            if extra.strip():
+                markers.append('extra == "{}"'.format(extra.strip()))
+            if markers:
+                requirement = '{}; {}'.format(requirement.strip(),
+                                              ' and '.join(markers))
+            requires_dist.append(requirement.strip())
+    return requires_dist
+
+
+def evaluate_setup_argument(node, names):
+    """Evaluate an argument of a setup() call in a setup.py.
+
+    Understands literals, names of module-level variables, list
+    concatenation and dict(...) calls, which is what setup.py files of Zope
+    packages use.
+
+    Raises ValueError for anything else.
+    """
+    if isinstance(node, ast.Name) and node.id in names:
+        return names[node.id]
+    if isinstance(node, (ast.List, ast.Tuple)):
+        return [evaluate_setup_argument(item, names) for item in node.elts]
+    if isinstance(node, ast.Dict):
+        if None in node.keys:
+            raise ValueError('cannot evaluate **kwargs')
+        return {evaluate_setup_argument(key, names):
+                evaluate_setup_argument(value, names)
+                for key, value in zip(node.keys, node.values)}
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name)
+            and node.func.id == 'dict' and not node.args):
+        if any(kw.arg is None for kw in node.keywords):
+            raise ValueError('cannot evaluate **kwargs')
+        return {kw.arg: evaluate_setup_argument(kw.value, names)
+                for kw in node.keywords}
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+        return (evaluate_setup_argument(node.left, names) +
+                evaluate_setup_argument(node.right, names))
+    return ast.literal_eval(node)
+
+
+def requires_dist_from_setup_py(source):
+    """Extract requirements from the setup() call in a setup.py.
+
+    The setup.py is parsed, not executed.
+
+    Returns a list of Requires-Dist entries, or None if there's no setup()
+    call.
+    """
+    tree = ast.parse(source)
+    names = {}
+    for node in tree.body:
+        if (isinstance(node, ast.Assign) and len(node.targets) == 1
+                and isinstance(node.targets[0], ast.Name)):
+            try:
+                names[node.targets[0].id] = evaluate_setup_argument(
+                    node.value, names)
+            except (ValueError, TypeError):
+                pass
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call):
+            continue
+        func = node.func
+        if not (isinstance(func, ast.Name) and func.id == 'setup' or
+                isinstance(func, ast.Attribute) and func.attr == 'setup'):
+            continue
+        kwargs = {kw.arg: kw.value for kw in node.keywords}
+        try:
+            install_requires = evaluate_setup_argument(
+                kwargs['install_requires'], names
+            ) if 'install_requires' in kwargs else []
+            extras_require = evaluate_setup_argument(
+                kwargs['extras_require'], names
+            ) if 'extras_require' in kwargs else {}
+        except (ValueError, TypeError) as e:
+            raise Error('Cannot evaluate setup() arguments: {}'.format(e))
+        return requires_dist_from_setuptools(install_requires, extras_require)
+    return None
+
+
+def requires_dist_from_setup_cfg(text):
+    """Extract requirements from the [options] of a setup.cfg.
+
+    Returns a list of Requires-Dist entries, or None if setup.cfg doesn't
+    list any requirements.
+    """
+    cp = configparser.ConfigParser(interpolation=None)
+    cp.read_string(text)
+    if not cp.has_option('options', 'install_requires') and \
+            not cp.has_section('options.extras_require'):
+        return None
+    install_requires = cp.get('options', 'install_requires', fallback='')
+    extras_require = {}
+    if cp.has_section('options.extras_require'):
+        extras_require = dict(cp.items('options.extras_require'))
+    return requires_dist_from_setuptools(install_requires, extras_require)
+
+
+def requires_dist_from_pyproject_toml(text):
+    """Extract requirements from the [project] table of a pyproject.toml.
+
+    Returns a list of Requires-Dist entries, or None if pyproject.toml
+    doesn't list any requirements (or if we can't parse TOML).
+    """
+    if tomllib is None:
+        return None
+    project = tomllib.loads(text).get('project', {})
+    if 'dependencies' not in project and \
+            'optional-dependencies' not in project:
+        return None
+    return requires_dist_from_setuptools(
+        project.get('dependencies', []),
+        project.get('optional-dependencies', {}))
+
+
+def read_git_requirements(repo_url, mirrors_dir):
+    """Read the requirements of a package from its git repository.
+
+    Keeps a shallow mirror of the repository in mirrors_dir (see gitmirror)
+    and looks at pyproject.toml, setup.cfg and setup.py at HEAD, in that
+    order.
+
+    Returns a tuple (requirements, extras), like parse_requires_dist().
+    """
+    mirror_dir = gitmirror.update_mirror(repo_url, mirrors_dir)
+    parsers = [('pyproject.toml', requires_dist_from_pyproject_toml),
+               ('setup.cfg', requires_dist_from_setup_cfg),
+               ('setup.py', requires_dist_from_setup_py)]
+    files = gitmirror.list_files(mirror_dir, [fn for fn, _ in parsers])
+    for filename, parse in parsers:
+        if filename not in files:
+            continue
+        requires_dist = parse(
+            gitmirror.read_file(mirror_dir, filename).decode('UTF-8'))
+        if requires_dist is not None:
+            return parse_requires_dist(requires_dist)
+    raise Error('Could not find requirements in {}'.format(repo_url))
+
+
 def dump_pretty_json(data, fp=sys.stdout):
     """Dump pretty-printed JSON data to a file."""
     json.dump(data, fp, sort_keys=True, indent=2, separators=(',', ': '))
@@ -188,12 +812,62 @@ def main():
         formatter_class=ArgFormatter)
     parser.add_argument('--cache-dir', metavar='DIR', default='.cache',
                         help='directory for caching downloaded sdists')
+    parser.add_argument('--cache-max-bytes', metavar='N', type=int,
+                        help='remove the least recently used sdists from the'
+                             ' cache directory after a run until the sdists'
+                             ' there take at most N bytes (sdists of the'
+                             ' packages in the input are never removed)')
+    parser.add_argument('--gc', action='store_true',
+                        help='just remove old sdists from the cache'
+                             ' directory, down to --cache-max-bytes'
+                             ' (which is required)')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                        help='number of sdists to download in parallel')
+    parser.add_argument('--wheels', action='store_true',
+                        help='read requirements from the metadata of wheels'
+                             ' on PyPI when available (fetching just a few'
+                             ' KB of each) instead of downloading sdists')
+    parser.add_argument('--git-mirrors', metavar='DIR',
+                        help='read requirements of packages that have no'
+                             ' sdist but have a github_web_url from their'
+                             ' git repositories, keeping shallow mirrors'
+                             ' in DIR')
+    parser.add_argument('--parse-workers', metavar='N', type=int, default=1,
+                        help='number of processes for decompressing and'
+                             ' parsing sdists')
+    parser.add_argument('--requires-dist', action='store_true',
+                        help='use requirements from PyPI metadata when'
+                             ' available instead of downloading sdists')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='write the output to FILE (atomically) instead'
+                             ' of stdout')
+    parser.add_argument('--journal', metavar='FILE',
+                        default='.cache/get_deps.journal',
+                        help='record finished packages in FILE, so that an'
+                             ' interrupted run can be resumed')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip packages recorded in the journal by an'
+                             ' interrupted run')
     args = parser.parse_args()
     args.cache_dir = os.path.expanduser(args.cache_dir)
+    if args.git_mirrors:
+        args.git_mirrors = os.path.expanduser(args.git_mirrors)
 
     if sys.stdin.isatty():
         parser.error('refusing to read from a terminal')
 
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+
+    if args.parse_workers < 1:
+        parser.error('--parse-workers must be at least 1')
+
+    if args.cache_max_bytes is not None and args.cache_max_bytes < 0:
+        parser.error('--cache-max-bytes must not be negative')
+
+    if args.gc and args.cache_max_bytes is None:
+        parser.error('--gc needs --cache-max-bytes')
+
     if not os.path.isdir(args.cache_dir):
         try:
             os.makedirs(args.cache_dir)
@@ -201,29 +875,156 @@ def main():
             parser.error('Could not create cache directory: {}: {}'.format(
                          e.__class__.__name__, e))
 
-    packages = json.load(sys.stdin)
-    for info in packages:
-        package_name = info['name']
-        sdist_url = info.get('sdist_url')
-        requirements, extras = [], {}
-        if sdist_url:
-            try:
-                sdist_filename = get_local_sdist(sdist_url, args.cache_dir)
-            except Exception as e:
-                print('Could not fetch sdist {}: {}: {}'.format(
-                            sdist_url, e.__class__.__name__, e),
-                          file=sys.stderr)
+    index = RequirementsIndex(os.path.join(args.cache_dir, REQUIREMENTS_INDEX))
+    access_index = AccessIndex(os.path.join(args.cache_dir, ACCESS_INDEX))
+
+    def collect_garbage(packages, max_bytes):
+        protected = {os.path.basename(get_cache_filename(info['sdist_url'],
+                                                         args.cache_dir))
+                     for info in packages if info.get('sdist_url')}
+        reclaimed, removed = evict_from_cache(args.cache_dir, max_bytes,
+                                              protected, access_index)
+        for name in removed:
+            index.discard(name)
+            access_index.discard(name)
+        index.save()
+        access_index.save()
+        if removed or args.gc:
+            print('Removed {} files ({} bytes) from {}'.format(
+                      len(removed), reclaimed, args.cache_dir),
+                  file=sys.stderr)
+
+    if args.gc:
+        collect_garbage(json.load(sys.stdin), args.cache_max_bytes)
+        return
+
+    journal_dir = os.path.dirname(args.journal)
+    try:
+        if journal_dir and not os.path.isdir(journal_dir):
+            os.makedirs(journal_dir)
+        journal = Journal(args.journal, resume=args.resume)
+    except Exception as e:
+        parser.error('Could not open journal: {}: {}'.format(
+                     e.__class__.__name__, e))
+
+    if args.parse_workers > 1:
+        # The pool starts its processes when the downloader threads are
+        # already running, and forking a process that has threads can
+        # deadlock, so start them from scratch instead.
+        spawn = multiprocessing.get_context('spawn')
+        parse_pool = concurrent.futures.ProcessPoolExecutor(
+            args.parse_workers, mp_context=spawn)
+    else:
+        parse_pool = contextlib.nullcontext()
+
+    def fetch(sdist_url, sha256):
+        # Hand the sdist to a parser process as soon as it's downloaded,
+        # instead of waiting for main() to get to it.
+        sdist_filename = get_local_sdist(sdist_url, args.cache_dir, sha256)
+        access_index.touch(sdist_filename)
+        if args.parse_workers > 1 and index.get(sdist_filename) is None:
+            return sdist_filename, parse_pool.submit(read_requirements,
+                                                     sdist_filename)
+        return sdist_filename, None
+
+    def sdist_requirements(sdist_url, sha256):
+        filename = get_cache_filename(sdist_url, args.cache_dir)
+        if filename not in downloads:
+            downloads[filename] = executor.submit(fetch, sdist_url, sha256)
+        try:
+            sdist_filename, parsing = downloads[filename].result()
+        except Exception as e:
+            print('Could not fetch sdist {}: {}: {}'.format(
+                        sdist_url, e.__class__.__name__, e),
+                      file=sys.stderr)
+            return [], {}
+        try:
+            cached = index.get(sdist_filename)
+            if cached is not None:
+                return cached
+            elif parsing is not None:
+                requirements, extras = parsing.result()
             else:
+                requirements, extras = read_requirements(sdist_filename)
+            index.put(sdist_filename, requirements, extras)
+            return requirements, extras
+        except Exception as e:
+            print('Could not parse requires.txt for {}: {}: {}'.format(
+                        sdist_filename, e.__class__, e),
+                      file=sys.stderr)
+            return [], {}
+
+    packages = json.load(sys.stdin)
+    with parse_pool, \
+            concurrent.futures.ThreadPoolExecutor(args.jobs) as executor:
+        # Start all the downloads up front; the worker pool limits how many
+        # run at the same time.
+        downloads = {}
+        wheels = {}
+        repositories = {}
+        for info in packages:
+            if info['name'] in journal:
+                continue
+            if args.requires_dist and info.get('requires_dist') is not None:
+                continue
+            if args.wheels and info.get('wheel_url'):
+                wheels[info['name']] = executor.submit(
+                    read_wheel_requirements, info['wheel_url'])
+                continue
+            sdist_url = info.get('sdist_url')
+            if not sdist_url:
+                if args.git_mirrors and info.get('github_web_url'):
+                    repositories[info['name']] = executor.submit(
+                        read_git_requirements, info['github_web_url'],
+                        args.git_mirrors)
+                continue
+            filename = get_cache_filename(sdist_url, args.cache_dir)
+            if filename not in downloads:
+                downloads[filename] = executor.submit(
+                    fetch, sdist_url, info.get('sdist_sha256'))
+        for info in packages:
+            package_name = info['name']
+            if package_name in journal:
+                info.update(journal.get(package_name))
+                continue
+            sdist_url = info.get('sdist_url')
+            requirements, extras = [], {}
+            if args.requires_dist and info.get('requires_dist') is not None:
+                requirements, extras = parse_requires_dist(
+                    info['requires_dist'])
+            elif package_name in wheels:
                 try:
-                    requires_txt_data = extract_requirements(sdist_filename)
-                    requirements, extras = parse_requirements(requires_txt_data or b'')
+                    requirements, extras = wheels[package_name].result()
                 except Exception as e:
-                    print('Could not parse requires.txt for {}: {}: {}'.format(
-                                sdist_filename, e.__class__, e),
+                    print('Could not read wheel metadata {}: {}: {}'.format(
+                                info['wheel_url'], e.__class__.__name__, e),
                               file=sys.stderr)
-        info['requires'] = requirements
-        info['requires_extras'] = extras
-    dump_pretty_json(packages)
+                    if sdist_url:
+                        requirements, extras = sdist_requirements(
+                            sdist_url, info.get('sdist_sha256'))
+            elif sdist_url:
+                requirements, extras = sdist_requirements(
+                    sdist_url, info.get('sdist_sha256'))
+            elif package_name in repositories:
+                try:
+                    requirements, extras = repositories[package_name].result()
+                except Exception as e:
+                    print('Could not read requirements from {}: {}: {}'.format(
+                                info['github_web_url'], e.__class__.__name__,
+                                e),
+                              file=sys.stderr)
+            info['requires'] = requirements
+            info['requires_extras'] = extras
+            journal.add(info)
+    index.save()
+    access_index.save()
+    if args.cache_max_bytes is not None:
+        collect_garbage(packages, args.cache_max_bytes)
+    if args.output:
+        dump_pretty_json_atomically(packages, args.output)
+    else:
+        dump_pretty_json(packages)
+    journal.close(remove=True)
 
 
 if __name__ == '__main__':
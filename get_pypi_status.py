@@ -10,6 +10,9 @@ and produces an annotated JSON list ::
   [{"name": "zope.interface",
     "version": "4.0.3",
     "sdist_url": "http://...",
+    "sdist_sha256": "...",
+    "requires_dist": ["setuptools"],
+    "wheel_url": "http://...",
     "supports": ["2.6", "2.7", "3.2", "3.3"]}, ...]
 
 The information is extracted from the Python Package Index (PyPI),
@@ -19,16 +22,26 @@ This script requires Python 3.
 """
 
 import argparse
-import email
+import concurrent.futures
+import email.utils
 import functools
+import itertools
 import json
 import os
+import random
+import re
+import sqlite3
 import sys
+import threading
 import time
-import urllib.request
+import urllib.error
+import xmlrpc.client
 from urllib.parse import urljoin
 from io import StringIO
 
+import httpclient
+from checkpoint import Journal, dump_pretty_json_atomically
+
 
 class Error(Exception):
     """An error that is not a bug in this script."""
@@ -39,101 +52,857 @@ PYPI_SERVER = 'https://pypi.org/pypi'
 # The PyPI API we use is documented at
 # https://warehouse.readthedocs.io/api-reference/json/#project
 
+# The changelog API we use for incremental updates is documented at
+# https://warehouse.readthedocs.io/api-reference/xml-rpc/#changelog-since-serial
+
+SERIAL_FILENAME = 'last_serial'
+
 
 ONE_DAY = 24*60*60  # seconds
 UNLIMITED = None
 
+# Version 1 was full PyPI JSON documents, with cache validators in a separate
+# file; version 2 added projection (see project_metadata()); version 3 added
+# info.requires_dist and a wheel to the projection.  The current version is
+# described in DirectoryCache.
+CACHE_SCHEMA = 3
 
-def get_cache_filename(package_name, cache_dir):
-    """Compute the pathname of the cache file corresponding to sdist_url."""
-    return os.path.join(cache_dir, package_name + '.json')
 
+def preferred_wheel(metadata):
+    """Pick the wheel of the latest release that we'd want to look at.
 
-def get_cached_metadata(package_name, cache_dir, max_age=ONE_DAY):
-    """Compute the pathname of the cache file corresponding to sdist_url."""
-    filename = get_cache_filename(package_name, cache_dir)
-    try:
-        with open(filename) as f:
-            mtime = os.fstat(f.fileno()).st_mtime
-            if max_age is not UNLIMITED and time.time() - mtime > max_age:
-                return None
-            return json.load(f)
-    except IOError:
+    Prefers pure Python wheels, because they're the same for every
+    platform.  Returns an item of metadata['urls'], or None if there are
+    no wheels.
+    """
+    wheels = [url for url in metadata['urls']
+              if url['packagetype'] == 'bdist_wheel']
+    for url in wheels:
+        if url['filename'].endswith('-none-any.whl'):
+            return url
+    return wheels[0] if wheels else None
+
+
+def project_metadata(metadata):
+    """Strip PyPI metadata down to the parts that we use.
+
+    The full JSON document lists every file of every release, which can be
+    megabytes for old packages.  We only need the latest version number,
+    the classifiers, the requirements, the sdist and one wheel of the latest
+    release (a pure Python one if there is one) and the serial number.
+
+    The result has the same structure as the full document, so you can
+    pass it to extract_interesting_information().
+    """
+    if not metadata:
+        return {}
+    info = metadata['info']
+    projected = {
+        'info': {
+            'version': info['version'],
+            'classifiers': info['classifiers'],
+            'requires_dist': info.get('requires_dist'),
+        },
+        'urls': [url for url in metadata['urls']
+                 if url['packagetype'] == 'sdist'],
+    }
+    wheel = preferred_wheel(metadata)
+    if wheel is not None:
+        projected['urls'].append(wheel)
+    if 'last_serial' in metadata:
+        projected['last_serial'] = metadata['last_serial']
+    return projected
+
+
+class DirectoryCache(object):
+    """Metadata cache that keeps one JSON file per package.
+
+    A cache entry is a dict with keys 'schema' (always CACHE_SCHEMA),
+    'metadata' (projected PyPI metadata, or {} if the package is not on
+    PyPI) and 'validators' (see get_validators()).  Entries for packages
+    that are not on PyPI also have a 'ttl' (see get_metadata()).  The
+    modification time of the file tells us when the metadata was fetched.
+
+    The highest PyPI serial number we've seen is kept in a file named
+    SERIAL_FILENAME.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def get_filename(self, package_name):
+        """Compute the pathname of the cache file for a package."""
+        return os.path.join(self.cache_dir, package_name + '.json')
+
+    def get_validators_filename(self, package_name):
+        """Compute the pathname of an old-style cache validators file.
+
+        Cache schema 1 kept the ETag and Last-Modified headers that PyPI sent
+        in a separate file next to the cached metadata.
+        """
+        return os.path.join(self.cache_dir, package_name + '.validators')
+
+    def names(self):
+        """List the names of all cached packages."""
+        return sorted(fn[:-len('.json')] for fn in os.listdir(self.cache_dir)
+                      if fn.endswith('.json'))
+
+    def _read(self, package_name):
+        """Read the cache file of a package.
+
+        Returns a tuple (entry, mtime), or (None, None) if there's no
+        readable cache file.  The entry may be old-style.
+        """
+        filename = self.get_filename(package_name)
+        try:
+            with open(filename) as f:
+                mtime = os.fstat(f.fileno()).st_mtime
+                return json.load(f), mtime
+        except (IOError, ValueError):
+            return None, None
+
+    def _read_old_validators(self, package_name):
+        """Return the cache validators stored in an old-style sidecar file."""
+        filename = self.get_validators_filename(package_name)
+        try:
+            with open(filename) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def get(self, package_name):
+        """Read a cache entry for a package.
+
+        Returns a tuple (entry, fetched), or (None, None) if there's no
+        usable cache entry.  fetched is the time when the metadata was
+        fetched from PyPI.
+
+        Old-style entries (full PyPI JSON documents) are converted on the
+        fly.  Entries of other schema versions, and files that don't look
+        like either, are treated as missing.
+        """
+        entry, mtime = self._read(package_name)
+        if not isinstance(entry, dict):
+            return None, None
+        if 'schema' not in entry:
+            try:
+                metadata = project_metadata(entry)
+            except (KeyError, TypeError):
+                return None, None
+            entry = dict(schema=CACHE_SCHEMA, metadata=metadata,
+                         validators=self._read_old_validators(package_name))
+        elif entry['schema'] != CACHE_SCHEMA or 'metadata' not in entry:
+            return None, None
+        return entry, mtime
+
+    def put(self, package_name, metadata, validators=None, fetched=None,
+            ttl=None):
+        """Store projected package metadata in the cache."""
+        filename = self.get_filename(package_name)
+        entry = dict(schema=CACHE_SCHEMA, metadata=metadata,
+                     validators=validators or {})
+        if ttl is not None:
+            entry['ttl'] = ttl
+        try:
+            with open(filename, 'w') as f:
+                json.dump(entry, f, separators=(',', ':'))
+            if fetched is not None:
+                os.utime(filename, (fetched, fetched))
+        except IOError:
+            # cache not writable? ignore
+            pass
+
+    def touch(self, package_name):
+        """Mark cached metadata as fresh."""
+        filename = self.get_filename(package_name)
+        try:
+            os.utime(filename)
+        except IOError:
+            # cache not writable? ignore
+            pass
+
+    def migrate(self):
+        """Convert all old-style entries.
+
+        Preserves the modification times, so cache entries don't become
+        fresher than they are.
+
+        Returns the number of converted entries.
+        """
+        converted = 0
+        for package_name in self.names():
+            entry, mtime = self._read(package_name)
+            if entry is None or 'schema' in entry:
+                continue
+            entry, mtime = self.get(package_name)
+            if entry is None:
+                continue
+            self.put(package_name, entry['metadata'], entry['validators'],
+                     fetched=mtime)
+            validators_filename = self.get_validators_filename(package_name)
+            if os.path.exists(validators_filename):
+                os.unlink(validators_filename)
+            converted += 1
+        return converted
+
+    def get_last_serial(self):
+        """Return the highest PyPI serial number recorded in the cache.
+
+        Returns None if no serial number was recorded.
+        """
+        filename = os.path.join(self.cache_dir, SERIAL_FILENAME)
+        try:
+            with open(filename) as f:
+                return int(f.read())
+        except (IOError, ValueError):
+            return None
+
+    def put_last_serial(self, serial):
+        """Record the highest PyPI serial number in the cache."""
+        filename = os.path.join(self.cache_dir, SERIAL_FILENAME)
+        try:
+            with open(filename, 'w') as f:
+                f.write('{}\n'.format(serial))
+        except IOError:
+            # cache not writable? ignore
+            pass
+
+    def close(self):
+        """Release resources (there are none)."""
+
+
+class SQLiteCache(object):
+    """Metadata cache that keeps everything in a single SQLite database.
+
+    Has the same interface as DirectoryCache, but avoids opening, stat()ing
+    and parsing a file for every package.  Writes are committed in batches
+    of batch_size.
+
+    Safe to use from several threads at once.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS metadata (
+            name TEXT PRIMARY KEY,
+            fetched REAL NOT NULL,
+            status INTEGER NOT NULL,
+            schema INTEGER NOT NULL,
+            validators TEXT NOT NULL,
+            payload TEXT,
+            ttl REAL
+        );
+        CREATE INDEX IF NOT EXISTS metadata_fetched ON metadata (fetched);
+        CREATE TABLE IF NOT EXISTS state (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, filename, batch_size=100):
+        self.filename = filename
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.executescript(self.SCHEMA)
+        columns = [row[1] for row in self._db.execute(
+            'PRAGMA table_info(metadata)')]
+        if 'ttl' not in columns:
+            # databases created before negative cache TTLs were introduced
+            self._db.execute('ALTER TABLE metadata ADD COLUMN ttl REAL')
+
+    def names(self):
+        """List the names of all cached packages."""
+        with self._lock:
+            return [name for name, in self._db.execute(
+                'SELECT name FROM metadata ORDER BY name')]
+
+    def get(self, package_name):
+        """Read a cache entry for a package.
+
+        Returns a tuple (entry, fetched), or (None, None) if there's no
+        usable cache entry.  See DirectoryCache for the format of entries.
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT fetched, status, schema, validators, payload, ttl'
+                ' FROM metadata WHERE name = ?', (package_name, )).fetchone()
+        if row is None:
+            return None, None
+        fetched, status, schema, validators, payload, ttl = row
+        if schema != CACHE_SCHEMA:
+            return None, None
+        metadata = json.loads(payload) if status == 200 else {}
+        entry = dict(schema=schema, metadata=metadata,
+                     validators=json.loads(validators))
+        if ttl is not None:
+            entry['ttl'] = ttl
+        return entry, fetched
+
+    def put(self, package_name, metadata, validators=None, fetched=None,
+            ttl=None):
+        """Store projected package metadata in the cache."""
+        if fetched is None:
+            fetched = time.time()
+        status = 200 if metadata else 404
+        payload = json.dumps(metadata, separators=(',', ':')) if metadata \
+            else None
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO metadata'
+                ' (name, fetched, status, schema, validators, payload, ttl)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (package_name, fetched, status, CACHE_SCHEMA,
+                 json.dumps(validators or {}), payload, ttl))
+            self._wrote()
+
+    def touch(self, package_name):
+        """Mark cached metadata as fresh."""
+        with self._lock:
+            self._db.execute('UPDATE metadata SET fetched = ? WHERE name = ?',
+                             (time.time(), package_name))
+            self._wrote()
+
+    def _wrote(self):
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self._db.commit()
+            self._pending = 0
+
+    def get_last_serial(self):
+        """Return the highest PyPI serial number recorded in the cache.
+
+        Returns None if no serial number was recorded.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM state WHERE key = 'last_serial'"
+            ).fetchone()
+        return int(row[0]) if row else None
+
+    def put_last_serial(self, serial):
+        """Record the highest PyPI serial number in the cache."""
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO state (key, value)"
+                " VALUES ('last_serial', ?)", (str(serial), ))
+            self._wrote()
+
+    def import_from(self, other):
+        """Copy all entries from another cache.
+
+        Returns the number of copied entries.
+        """
+        copied = 0
+        for package_name in other.names():
+            entry, fetched = other.get(package_name)
+            if entry is not None:
+                self.put(package_name, entry['metadata'], entry['validators'],
+                         fetched=fetched, ttl=entry.get('ttl'))
+                copied += 1
+        return copied
+
+    def close(self):
+        """Commit pending writes and close the database."""
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+
+
+def is_fresh(fetched, max_age):
+    """Is metadata fetched at a given time younger than max_age seconds?"""
+    return max_age is UNLIMITED or time.time() - fetched <= max_age
+
+
+def get_cached_metadata(package_name, cache, max_age=ONE_DAY):
+    """Return cached metadata of a package.
+
+    Returns None if there's no cached metadata or if it's older than max_age
+    seconds.
+    """
+    entry, fetched = cache.get(package_name)
+    if entry is None or not is_fresh(fetched, max_age):
         return None
+    return entry['metadata']
+
+
+class TokenBucket(object):
+    """A thread-safe token bucket.
+
+    Hands out up to ``rate`` tokens per second, allowing bursts of up to
+    ``burst`` tokens.  Callers that find the bucket empty reserve a token
+    anyway and sleep until it becomes theirs, so concurrent callers queue
+    up in the order they arrived.
+    """
+
+    def __init__(self, rate, burst=1, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self.acquired = 0
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = burst
+        self._started = self._last = clock()
+
+    def _refill(self):
+        """Add the tokens that accumulated since the last call.
+
+        Must be called with the lock held.
+        """
+        now = self._clock()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self):
+        """Take a token from the bucket, waiting if necessary."""
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+            self.acquired += 1
+            delay = -self._tokens / self.rate
+        if delay > 0:
+            self._sleep(delay)
+
+    def pause(self, seconds):
+        """Hand out no tokens for the next few seconds."""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 0) - seconds * self.rate
+
+    def succeeded(self):
+        """Note that a request went through."""
 
+    def throttled(self, retry_after=None):
+        """Note that the server asked us to slow down."""
+        if retry_after:
+            self.pause(retry_after)
 
-def put_cached_metadata(package_name, cache_dir, metadata):
-    """Compute the pathname of the cache file corresponding to sdist_url."""
-    filename = get_cache_filename(package_name, cache_dir)
+    def effective_rate(self):
+        """Return the average number of tokens handed out per second."""
+        elapsed = self._clock() - self._started
+        return self.acquired / elapsed if elapsed > 0 else 0.0
+
+
+class AdaptiveRateLimiter(TokenBucket):
+    """A token bucket that finds the highest rate the server tolerates.
+
+    Uses additive increase, multiplicative decrease: every successful request
+    raises the rate a little (by about ``increase`` tokens per second for
+    every second of successful requests), and every time the server asks us
+    to slow down the rate is multiplied by ``decrease``.
+    """
+
+    def __init__(self, rate, min_rate=0.5, max_rate=50, increase=1.0,
+                 decrease=0.5, **kw):
+        super(AdaptiveRateLimiter, self).__init__(rate, **kw)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+
+    def succeeded(self):
+        """Note that a request went through and speed up a bit."""
+        with self._lock:
+            self._refill()
+            self.rate = min(self.max_rate,
+                            self.rate + self.increase / self.rate)
+
+    def throttled(self, retry_after=None):
+        """Note that the server asked us to slow down and slow down."""
+        with self._lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+        super(AdaptiveRateLimiter, self).throttled(retry_after)
+
+
+# 429 Too Many Requests and 503 Service Unavailable are how servers tell
+# us to slow down; the other 5xx errors are usually transient too.
+THROTTLE_CODES = {429, 503}
+RETRY_CODES = {429, 500, 502, 503, 504}
+
+# Never wait longer than this, whatever Retry-After says (a misconfigured
+# server could otherwise stall a worker for hours)
+MAX_RETRY_AFTER = 5*60  # seconds
+
+
+def parse_retry_after(headers, max_wait=MAX_RETRY_AFTER):
+    """Parse the Retry-After header of an HTTP response.
+
+    Returns the number of seconds to wait (but not more than max_wait), or
+    None.
+    """
+    value = headers.get('Retry-After') if headers is not None else None
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return min(int(value), max_wait)
     try:
-        with open(filename, 'w') as f:
-            json.dump(metadata, f)
-    except IOError:
-        # cache not writable? ignore
-        pass
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return min(max(0, when.timestamp() - time.time()), max_wait)
 
 
-def ratelimit(reqs_per_second):
+def ratelimit(limiter, max_retries=0, backoff=1.0, sleep=time.sleep,
+              jitter=random.random):
     """Make sure the decorated function is rate-limited.
 
-    Inserts delays to ensure the decorated function gets called not more than
-    reqs_per_second times per second.
+    Takes a token from limiter (if it's not None) before every call, so the
+    decorated function gets called not more often than the limiter allows,
+    even when it's called from several threads at once.
+
+    When the function fails with an HTTP error that asks us to slow down or
+    with a transient server error, the limiter is told about it, and the
+    call is retried up to max_retries times.  Retries wait as long as the
+    server asks in Retry-After, or else for an exponentially growing,
+    jittered delay starting at ``backoff`` seconds.
     """
-    interval = 1.0 / reqs_per_second
-    next_window = time.time()
 
     def _ratelimit(fn):
         @functools.wraps(fn)
         def _wrapper(*args, **kw):
-            nonlocal next_window
-            now = time.time()
-            if now < next_window:
-                time.sleep(next_window - now)
-                next_window += interval
-            else:
-                next_window = now + interval
-            return fn(*args, **kw)
+            for attempt in itertools.count():
+                if limiter is not None:
+                    limiter.acquire()
+                try:
+                    result = fn(*args, **kw)
+                except urllib.error.HTTPError as e:
+                    if e.code not in RETRY_CODES:
+                        if limiter is not None:
+                            limiter.succeeded()
+                        raise
+                    retry_after = parse_retry_after(e.headers)
+                    throttled = (limiter is not None
+                                 and e.code in THROTTLE_CODES)
+                    if throttled:
+                        limiter.throttled(retry_after)
+                    if attempt >= max_retries:
+                        raise
+                    if not (throttled and retry_after):
+                        # (otherwise the limiter will make us wait)
+                        sleep(retry_after or
+                              backoff * 2 ** attempt * (0.5 + jitter()))
+                else:
+                    if limiter is not None:
+                        limiter.succeeded()
+                    return result
         return _wrapper
 
     return _ratelimit
 
 
-def get_json(url):
-    """Perform HTTP GET for a URL, return deserialized JSON."""
-    with urllib.request.urlopen(url) as r:
-        # We expect PyPI to return UTF-8, but let's verify that.
-        content_type = r.info().get('Content-Type', '').lower()
-        if content_type not in ('application/json; charset="utf-8"',
-                                'application/json; charset=utf-8',
-                                'application/json'):
-            raise Error('Did not get UTF-8 JSON data from {}, got {}'
-                        .format(url, content_type))
-        return json.loads(r.read().decode('UTF-8'))
+def get_json_and_headers(url, headers=None):
+    """Perform HTTP GET for a URL, return deserialized JSON and headers.
+
+    Returns a tuple (json_data, headers) where headers is an instance
+    of email.message.Message.
+    """
+    return httpclient.get_json_and_headers(url, headers)
+
+
+def get_validators(headers):
+    """Extract cache validators from HTTP response headers."""
+    validators = {}
+    if headers.get('ETag'):
+        validators['etag'] = headers['ETag']
+    if headers.get('Last-Modified'):
+        validators['last_modified'] = headers['Last-Modified']
+    return validators
+
+
+def conditional_request_headers(validators):
+    """Compute HTTP request headers for revalidating a cached response."""
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
 
+class CachedNotFound(urllib.error.HTTPError):
+    """A 404 error that comes from the negative cache."""
 
-def get_metadata(package_name, cache_dir=None, max_age=ONE_DAY):
-    """Get package metadata from PyPI."""
+
+def negative_max_age(max_age, ttl, strict_max_age=False):
+    """Compute the maximum age of a cached "package not found" entry.
+
+    The entry's own TTL replaces the usual maximum age, except when the
+    caller wants cached data no matter how old it is (UNLIMITED), or wants
+    fresh data no matter what (0).  If strict_max_age is true (e.g. because
+    the user asked for a maximum age explicitly), a TTL longer than max_age
+    doesn't count either.
+    """
+    if max_age is UNLIMITED:
+        return max_age
+    if strict_max_age or max_age == 0:
+        return min(max_age, ttl)
+    return ttl
+
+
+def get_metadata(package_name, cache=None, max_age=ONE_DAY,
+                 negative_ttl=ONE_DAY, max_negative_ttl=30*ONE_DAY,
+                 strict_max_age=False):
+    """Get package metadata from PyPI.
+
+    Expired cache entries are revalidated with a conditional request, so
+    unchanged packages cost a 304 response instead of a full download.
+
+    The fact that a package is not on PyPI is cached for negative_ttl
+    seconds at first.  Every time PyPI confirms the package is still not
+    there, the TTL doubles, up to max_negative_ttl.  See negative_max_age()
+    for strict_max_age.
+    """
     url = '{base_url}/{package_name}/json'.format(
             base_url=PYPI_SERVER, package_name=package_name)
-    if cache_dir:
-        metadata = get_cached_metadata(package_name, cache_dir, max_age)
-        if metadata is not None:
-            if metadata == {}:
+    entry = None
+    if cache is not None:
+        entry, fetched = cache.get(package_name)
+        if entry is not None and entry['metadata'] == {}:
+            ttl = entry.get('ttl', negative_ttl)
+            if is_fresh(fetched, negative_max_age(max_age, ttl,
+                                                  strict_max_age)):
                 headers = email.message_from_string('\n\n')
-                raise urllib.error.HTTPError(url, 404, 'Not Found (cached)',
-                                             headers, StringIO())
-            return metadata
+                raise CachedNotFound(url, 404, 'Not Found (cached)',
+                                     headers, StringIO())
+        elif entry is not None and is_fresh(fetched, max_age):
+            return entry['metadata']
+    validators = entry['validators'] if entry else {}
     try:
-        metadata = get_json(url)
+        metadata, headers = get_json_and_headers(
+            url, conditional_request_headers(validators))
     except urllib.error.HTTPError as e:
-        if e.code == 404 and cache_dir:
-            put_cached_metadata(package_name, cache_dir, {})
+        if e.code == 304 and entry and entry['metadata']:
+            cache.touch(package_name)
+            return entry['metadata']
+        if e.code == 404 and cache is not None:
+            if entry is not None and entry['metadata'] == {}:
+                ttl = min(max_negative_ttl,
+                          2 * entry.get('ttl', negative_ttl))
+            else:
+                ttl = negative_ttl
+            cache.put(package_name, {}, ttl=ttl)
         raise
-    if cache_dir:
-        put_cached_metadata(package_name, cache_dir, metadata)
+    metadata = project_metadata(metadata)
+    if cache is not None:
+        cache.put(package_name, metadata, get_validators(headers))
     return metadata
 
 
+def is_not_found(error):
+    """Is this exception a 404 from PyPI?"""
+    return isinstance(error, urllib.error.HTTPError) and error.code == 404
+
+
+def fetch_metadata(package_name, cache=None, max_age=ONE_DAY, **kw):
+    """Get package metadata from PyPI, falling back to stale cached data.
+
+    Returns a tuple (metadata, error).  metadata is None if the package
+    is not on PyPI or if the request failed and there's nothing in the
+    cache; error is the exception that was raised, if any.
+
+    Keyword arguments are passed to get_metadata().
+
+    Safe to call from several threads at once.
+    """
+    try:
+        return get_metadata(package_name, cache, max_age=max_age, **kw), None
+    except Exception as e:
+        metadata = None
+        if cache is not None and not is_not_found(e):
+            # if there's an intermittent 502 error use stale data instead
+            # of reporting that this package doesn't exist on PyPI.
+            metadata = get_cached_metadata(package_name, cache,
+                                           max_age=UNLIMITED)
+        return metadata, e
+
+
+def annotate_packages(packages, max_ages, cache, executor, verbose=0,
+                      serial=None, journal=None, failed=None, **kw):
+    """Query PyPI about packages and annotate their records.
+
+    Updates the package records in place with the keys returned by
+    extract_interesting_information().
+
+    max_ages is a list of maximum ages of cached metadata, one for each
+    package.  The queries run in executor.
+
+    serial is the PyPI serial number we're going to reach (see plan_refresh).
+    Returns the serial number updated with the serial numbers of all
+    the packages, or None if some of the queries failed.
+
+    Finished package records are added to the journal, if one is given.
+
+    If you pass a set as failed, the names of packages whose queries failed
+    (other than with a 404) are added to it.
+
+    Keyword arguments are passed to get_metadata().
+    """
+    def fetch(package_name, max_age):
+        return fetch_metadata(package_name, cache, max_age, **kw)
+
+    prevmsglen = 0
+    negative_hits = 0
+    # executor.map() yields results in the order of the input, so the
+    # output doesn't depend on which requests happen to finish first.
+    results = executor.map(fetch, [info['name'] for info in packages],
+                           max_ages)
+    for n, (info, (metadata, error)) in enumerate(zip(packages, results)):
+        package_name = info['name']
+        if isinstance(error, CachedNotFound):
+            negative_hits += 1
+        if verbose:
+            msg = ("[{}/{}]: queried PyPI about {} ({} negative cache hits)"
+                   .format(n + 1, len(packages), package_name, negative_hits))
+            padding = " " * max(0, prevmsglen - len(msg))
+            sys.stderr.write("\r{}{}".format(msg, padding))
+            sys.stderr.flush()
+            prevmsglen = len(msg)
+
+        if error is not None and (verbose > 1 or not is_not_found(error)):
+            print('\nCould not fetch metadata about {}: {}: {}'.format(
+                    package_name, error.__class__.__name__, error),
+                  file=sys.stderr)
+            prevmsglen = 0
+            if not is_not_found(error):
+                # we'd miss this package's changes next time
+                serial = None
+                if failed is not None:
+                    failed.add(package_name)
+        if metadata:
+            info.update(extract_interesting_information(metadata))
+            if serial is not None:
+                serial = max(serial, metadata.get('last_serial', 0))
+        else:
+            info.update(version=None, sdist_url=None, sdist_sha256=None,
+                        requires_dist=None, wheel_url=None, supports=[])
+        if journal is not None:
+            journal.add(info)
+    return serial
+
+
+def add_max_stale(max_age, max_stale):
+    """Compute how old stale cached metadata may be."""
+    return UNLIMITED if max_age is UNLIMITED else max_age + max_stale
+
+
+def annotate_packages_stale(packages, max_ages, max_stale, output, cache,
+                            executor, done=(), verbose=0, serial=None,
+                            journal=None, negative_ttl=ONE_DAY,
+                            strict_max_age=False, **kw):
+    """Query PyPI about packages, writing out stale results first.
+
+    Annotates the package records like annotate_packages() does, except
+    that cached metadata up to max_stale seconds past its max age is good
+    enough, and writes all the records to the output file right away.
+    Then refreshes the packages whose cached metadata has expired, except
+    those whose queries have just failed (they'd most likely fail again).
+    The caller is expected to write the output file again afterwards.
+
+    Packages named in done are already annotated (e.g. from a journal), so
+    they're only refreshed.
+
+    Returns the serial number, like annotate_packages() does.
+    """
+    todo = [(info, max_age) for info, max_age in zip(packages, max_ages)
+            if info['name'] not in done]
+    failed = set()
+    serial = annotate_packages(
+        [info for info, max_age in todo],
+        [add_max_stale(max_age, max_stale) for info, max_age in todo],
+        cache, executor, verbose=verbose, serial=serial, journal=journal,
+        failed=failed, negative_ttl=negative_ttl,
+        strict_max_age=strict_max_age, **kw)
+    dump_pretty_json_atomically(packages, output)
+    stale = [(info, max_age) for info, max_age in zip(packages, max_ages)
+             if info['name'] not in failed
+             and needs_refresh(info['name'], cache, max_age, negative_ttl,
+                               strict_max_age)]
+    if verbose:
+        print("\nWrote {}, refreshing {} stale packages".format(
+                output, len(stale)), file=sys.stderr)
+    if stale:
+        serial = annotate_packages(
+            [info for info, max_age in stale],
+            [max_age for info, max_age in stale],
+            cache, executor, verbose=verbose, serial=serial, journal=journal,
+            negative_ttl=negative_ttl, strict_max_age=strict_max_age, **kw)
+    return serial
+
+
+def needs_refresh(package_name, cache, max_age, negative_ttl=ONE_DAY,
+                  strict_max_age=False):
+    """Is the cached metadata of a package older than max_age seconds?
+
+    Cached "package not found" entries have their own TTL instead, see
+    negative_max_age().
+    """
+    entry, fetched = cache.get(package_name)
+    if entry is None:
+        return True
+    if entry['metadata'] == {}:
+        max_age = negative_max_age(max_age, entry.get('ttl', negative_ttl),
+                                   strict_max_age)
+    return not is_fresh(fetched, max_age)
+
+
+def canonical_name(package_name):
+    """Normalize a package name for comparison (see PEP 503)."""
+    return re.sub(r'[-_.]+', '-', package_name).lower()
+
+
+class XMLRPCChangelog(object):
+    """Ask PyPI which projects changed recently.
+
+    Anything with the same two methods can be used instead of this, e.g. a
+    fake changelog in tests.
+    """
+
+    def __init__(self, url=PYPI_SERVER):
+        self.url = url
+
+    def last_serial(self):
+        """Return the serial number of the latest change on PyPI."""
+        return xmlrpc.client.ServerProxy(self.url).changelog_last_serial()
+
+    def changed_since(self, serial):
+        """List projects that changed since a given serial number.
+
+        Returns a tuple (names, last_serial) where names is a set of
+        canonical project names.
+        """
+        changes = xmlrpc.client.ServerProxy(self.url).changelog_since_serial(
+            serial)
+        names = {canonical_name(name)
+                 for name, version, timestamp, action, change_serial
+                 in changes}
+        last_serial = max([change[4] for change in changes], default=serial)
+        return names, last_serial
+
+
+def plan_refresh(package_names, changelog, last_serial):
+    """Decide how old cached metadata can be for each package.
+
+    If we know the PyPI serial number of our last run, only the projects
+    that changed since then need to be fetched again; everything else can
+    come from the cache, however old.  Otherwise all the packages have to
+    be fetched (or at least revalidated): a cached entry may predate
+    changes that later runs would never look for again.
+
+    Returns a tuple (max_ages, serial), where max_ages is a list of maximum
+    ages for package_names and serial is the PyPI serial number that will
+    be reached once all of those packages are refreshed.
+    """
+    if last_serial is None:
+        return [0] * len(package_names), changelog.last_serial()
+    changed, serial = changelog.changed_since(last_serial)
+    max_ages = [0 if canonical_name(name) in changed else UNLIMITED
+                for name in package_names]
+    return max_ages, max(serial, last_serial)
+
+
 def extract_py_versions(classifiers):
     """Extract a list of supported Python versions from trove classifiers."""
     pypy = 'Programming Language :: Python :: Implementation :: PyPy'
@@ -166,7 +935,10 @@ def extract_interesting_information(metadata):
     info = metadata['info']
     return dict(version=info['version'],
                 supports=extract_py_versions(info['classifiers']),
-                sdist_url=extract_sdist_url(metadata))
+                sdist_url=extract_sdist_url(metadata),
+                sdist_sha256=extract_sdist_sha256(metadata),
+                requires_dist=info.get('requires_dist'),
+                wheel_url=extract_wheel_url(metadata))
 
 
 def extract_sdist_url(metadata):
@@ -177,6 +949,23 @@ def extract_sdist_url(metadata):
     return None
 
 
+def extract_sdist_sha256(metadata):
+    """Extract the SHA-256 checksum of the source distribution."""
+    for info in metadata['urls']:
+        if info['packagetype'] == 'sdist':
+            return info.get('digests', {}).get('sha256')
+    return None
+
+
+def extract_wheel_url(metadata):
+    """Extract the URL for downloading a wheel of the latest release.
+
+    See preferred_wheel() for which one.
+    """
+    wheel = preferred_wheel(metadata)
+    return urljoin(PYPI_SERVER, wheel['url']) if wheel else None
+
+
 def dump_pretty_json(data, fp=sys.stdout):
     """Dump pretty-printed JSON data to a file."""
     json.dump(data, fp, sort_keys=True, indent=2, separators=(',', ': '))
@@ -203,67 +992,189 @@ def main():
         formatter_class=ArgFormatter)
     parser.add_argument('--cache-dir', metavar='DIR', default='.cache/meta',
                         help='directory for caching PyPI metadata')
-    parser.add_argument('--cache-max-age', metavar='AGE', default=ONE_DAY,
-                        help='maximum age of cached metadata in seconds')
+    parser.add_argument('--cache-db', metavar='FILE',
+                        help='cache PyPI metadata in an SQLite database'
+                             ' instead of a directory')
+    parser.add_argument('--cache-max-age', metavar='AGE',
+                        default=argparse.SUPPRESS,
+                        help='maximum age of cached metadata in seconds'
+                             ' (default: one day, but a package that is not'
+                             ' on PyPI is remembered for as long as'
+                             ' --negative-cache-max-age says unless you'
+                             ' set this explicitly)')
+    parser.add_argument('--negative-cache-max-age', metavar='AGE', type=int,
+                        default=ONE_DAY,
+                        help='how long to remember that a package is not on'
+                             ' PyPI, in seconds (doubles every time PyPI'
+                             ' confirms it)')
+    parser.add_argument('--max-negative-cache-max-age', metavar='AGE',
+                        type=int, default=30*ONE_DAY,
+                        help='upper limit for --negative-cache-max-age')
     parser.add_argument('-v', '--verbose', action='count', default=0,
                         help='be more verbose (can be repeated)')
     parser.add_argument('--rate-limit', metavar='REQS-PER-SECOND', type=float,
                         default=5, help='rate-limit PyPI requests')
+    parser.add_argument('--adaptive-rate-limit', action='store_true',
+                        help='start with --rate-limit, then speed up or slow'
+                             ' down depending on how PyPI responds')
+    parser.add_argument('--max-rate-limit', metavar='REQS-PER-SECOND',
+                        type=float, default=50,
+                        help='upper bound for --adaptive-rate-limit')
+    parser.add_argument('--retries', metavar='N', type=int, default=3,
+                        help='retry requests that fail with 429 or 5xx errors'
+                             ' up to N times')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                        help='number of PyPI requests to make in parallel')
+    parser.add_argument('--incremental', action='store_true',
+                        help='refresh only the packages that changed on PyPI'
+                             ' since the last --incremental run')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='write the output to FILE (atomically) instead'
+                             ' of stdout')
+    parser.add_argument('--stale-while-revalidate', metavar='MAX_STALE',
+                        help='write the output right away, using cached'
+                             ' metadata up to MAX_STALE seconds past'
+                             ' --cache-max-age, then refresh stale metadata'
+                             ' and write the output again (requires'
+                             ' --output)')
+    parser.add_argument('--journal', metavar='FILE',
+                        default='.cache/get_pypi_status.journal',
+                        help='record finished packages in FILE, so that an'
+                             ' interrupted run can be resumed')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip packages recorded in the journal by an'
+                             ' interrupted run')
+    parser.add_argument('--migrate-cache', action='store_true',
+                        help='convert old-style cache entries to the compact'
+                             ' format (or, with --cache-db, copy them from'
+                             ' --cache-dir into the database) and exit')
     args = parser.parse_args()
 
+    if args.migrate_cache:
+        if args.cache_db:
+            cache = SQLiteCache(args.cache_db)
+            converted = cache.import_from(DirectoryCache(args.cache_dir))
+            cache.close()
+        else:
+            converted = DirectoryCache(args.cache_dir).migrate()
+        print('Converted {} cache entries'.format(converted), file=sys.stderr)
+        return
+
     if sys.stdin.isatty():
         parser.error('refusing to read from a terminal')
 
-    if not os.path.isdir(args.cache_dir):
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+
+    if args.stale_while_revalidate is not None and not args.output:
+        parser.error('--stale-while-revalidate requires --output')
+
+    if args.cache_db:
         try:
-            os.makedirs(args.cache_dir)
+            cache = SQLiteCache(args.cache_db)
         except Exception as e:
-            parser.error('Could not create cache directory: {}: {}'.format(
+            parser.error('Could not open cache database: {}: {}'.format(
                          e.__class__.__name__, e))
+    else:
+        if not os.path.isdir(args.cache_dir):
+            try:
+                os.makedirs(args.cache_dir)
+            except Exception as e:
+                parser.error('Could not create cache directory: {}: {}'.format(
+                             e.__class__.__name__, e))
+        cache = DirectoryCache(args.cache_dir)
 
-    global get_json
+    global get_json_and_headers
+    limiter = None
     if args.rate_limit > 0:
-        if args.verbose:
-            print("Rate-limiting to {} requests per second".format(
-                    args.rate_limit), file=sys.stderr)
-        get_json = ratelimit(args.rate_limit)(get_json)
+        if args.adaptive_rate_limit:
+            if args.verbose:
+                print("Rate-limiting to {} requests per second at first,"
+                      " adapting up to {}".format(
+                        args.rate_limit, args.max_rate_limit),
+                      file=sys.stderr)
+            limiter = AdaptiveRateLimiter(args.rate_limit,
+                                          max_rate=args.max_rate_limit)
+        else:
+            if args.verbose:
+                print("Rate-limiting to {} requests per second".format(
+                        args.rate_limit), file=sys.stderr)
+            limiter = TokenBucket(args.rate_limit)
     else:
         if args.verbose:
             print("Rate-limiting disabled", file=sys.stderr)
+    get_json_and_headers = ratelimit(limiter, max_retries=args.retries)(
+        get_json_and_headers)
 
     packages = json.load(sys.stdin)
-    prevmsglen = 0
-    for n, info in enumerate(packages):
-        package_name = info['name']
-        if args.verbose:
-            msg = "[{}/{}]: querying PyPI about {}".format(
-                                n + 1, len(packages), package_name)
-            padding = " " * max(0, prevmsglen - len(msg))
-            sys.stderr.write("\r{}{}".format(msg, padding))
-            sys.stderr.flush()
-            prevmsglen = len(msg)
-
-        metadata = None
+    package_names = [info['name'] for info in packages]
+    max_ages = [int(getattr(args, 'cache_max_age', ONE_DAY))] * len(packages)
+    serial = None
+    if args.incremental:
+        last_serial = cache.get_last_serial()
         try:
-            metadata = get_metadata(package_name, args.cache_dir,
-                                    max_age=int(args.cache_max_age))
+            max_ages, serial = plan_refresh(package_names, XMLRPCChangelog(),
+                                            last_serial)
         except Exception as e:
-            not_found = isinstance(e, urllib.error.HTTPError) and e.code == 404
-            if args.verbose > 1 or not not_found:
-                print('\nCould not fetch metadata about {}: {}: {}'.format(
-                        package_name, e.__class__.__name__, e),
-                      file=sys.stderr)
-                prevmsglen = 0
-            if not not_found:
-                # if there's an intermittent 502 error use stale data instead
-                # of reporting that this package doesn't exist on PyPI.
-                metadata = get_cached_metadata(package_name, args.cache_dir,
-                                               max_age=UNLIMITED)
-        if metadata:
-            info.update(extract_interesting_information(metadata))
+            print('Could not fetch the PyPI changelog: {}: {}'.format(
+                    e.__class__.__name__, e), file=sys.stderr)
+        else:
+            if args.verbose and last_serial is not None:
+                print('{} packages changed since serial {}'.format(
+                        max_ages.count(0), last_serial), file=sys.stderr)
+
+    journal_dir = os.path.dirname(args.journal)
+    try:
+        if journal_dir and not os.path.isdir(journal_dir):
+            os.makedirs(journal_dir)
+        journal = Journal(args.journal, resume=args.resume)
+    except Exception as e:
+        parser.error('Could not open journal: {}: {}'.format(
+                     e.__class__.__name__, e))
+    todo = []
+    for info, max_age in zip(packages, max_ages):
+        if info['name'] in journal:
+            info.update(journal.get(info['name']))
+        else:
+            todo.append((info, max_age))
+    if len(todo) < len(packages):
+        if args.verbose:
+            print("Resuming: {} packages already done".format(
+                    len(packages) - len(todo)), file=sys.stderr)
+        # we don't know the serial numbers of the packages done last time
+        serial = None
+
+    negative_ttls = dict(negative_ttl=args.negative_cache_max_age,
+                         max_negative_ttl=args.max_negative_cache_max_age,
+                         strict_max_age=hasattr(args, 'cache_max_age'))
+    with concurrent.futures.ThreadPoolExecutor(args.jobs) as executor:
+        if args.stale_while_revalidate is not None:
+            done = {info['name'] for info in packages} - {
+                info['name'] for info, max_age in todo}
+            serial = annotate_packages_stale(
+                packages, max_ages, int(args.stale_while_revalidate),
+                args.output, cache, executor, done=done,
+                verbose=args.verbose, serial=serial, journal=journal,
+                **negative_ttls)
         else:
-            info.update(version=None, sdist_url=None, supports=[])
-    dump_pretty_json(packages)
+            serial = annotate_packages(
+                [info for info, max_age in todo],
+                [max_age for info, max_age in todo],
+                cache, executor, verbose=args.verbose, serial=serial,
+                journal=journal, **negative_ttls)
+    if serial is not None:
+        cache.put_last_serial(serial)
+    cache.close()
+    if args.verbose and limiter is not None:
+        print("\nMade {} requests, {:.1f} per second on average"
+              " (rate limit at the end: {:.1f} per second)".format(
+                limiter.acquired, limiter.effective_rate(), limiter.rate),
+              file=sys.stderr)
+    if args.output:
+        dump_pretty_json_atomically(packages, args.output)
+    else:
+        dump_pretty_json(packages)
+    journal.close(remove=True)
 
 
 if __name__ == '__main__':
@@ -23,10 +23,11 @@ import itertools
 import json
 import subprocess
 import sys
-import urllib.request
 from operator import itemgetter
 from collections import defaultdict
 
+import httpclient
+
 
 class Error(Exception):
     """An error that is not a bug in this script."""
@@ -118,16 +119,11 @@ def get_json_and_headers(url):
     """Perform HTTP GET for a URL, return deserialized JSON and headers.
 
     Returns a tuple (json_data, headers) where headers is an instance
-    of email.message.Message (because that's what urllib gives us).
+    of email.message.Message.
     """
-    with urllib.request.urlopen(url) as r:
-        # We expect Github to return UTF-8, but let's verify that.
-        content_type = r.info().get('Content-Type', '').lower()
-        if content_type not in ('application/json; charset="utf-8"',
-                                'application/json; charset=utf-8'):
-            raise Error('Did not get UTF-8 JSON data from {}, got {}'
-                        .format(url, content_type))
-        return json.loads(r.read().decode('UTF-8')), r.info()
+    # We expect Github to say it's UTF-8, but let's verify that.
+    return httpclient.get_json_and_headers(
+        url, content_types=httpclient.UTF8_JSON_CONTENT_TYPES)
 
 
 def get_github_list(url, batch_size=100):
@@ -0,0 +1,98 @@
+"""Shallow bare git mirrors of project repositories.
+
+get_deps.py uses these to look at the setup.py (or setup.cfg, or
+pyproject.toml) of packages that have never been released to PyPI.  A mirror
+has just the latest commit of the default branch and its directory trees;
+the contents of files are fetched on demand from the remote, when somebody
+asks for them.  So reading one file of a project costs a couple of small
+fetches instead of a full clone, and nothing is ever checked out.
+
+Requires Python 3 and the 'git' command-line tool.
+"""
+
+import os
+import subprocess
+from urllib.parse import urlsplit
+
+
+class Error(Exception):
+    """An error that is not a bug in this script."""
+
+
+# The ref that holds the mirrored HEAD of the remote repository
+MIRROR_REF = 'refs/heads/upstream'
+
+
+def git(*args, git_dir=None):
+    """Run a git command and return its output (bytes)."""
+    command = ['git']
+    if git_dir is not None:
+        command += ['--git-dir', git_dir]
+    command += args
+    # Don't ask for a password when a repository doesn't exist: Github
+    # says "authentication required" for those.
+    env = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+    result = subprocess.run(command, stdin=subprocess.DEVNULL,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            env=env)
+    if result.returncode != 0:
+        raise Error('git {} failed: {}'.format(
+            args[0], result.stderr.decode('UTF-8', 'replace').strip()))
+    return result.stdout
+
+
+def get_mirror_dir(repo_url, mirrors_dir):
+    """Compute the pathname of the mirror of a repository.
+
+        >>> get_mirror_dir('https://github.com/zopefoundation/zope.foo',
+        ...                '/cache')
+        '/cache/github.com/zopefoundation/zope.foo.git'
+
+    """
+    parts = urlsplit(repo_url)
+    path = (parts.netloc + parts.path).strip('/')
+    if path.endswith('.git'):
+        path = path[:-len('.git')]
+    return os.path.join(mirrors_dir, path + '.git')
+
+
+def update_mirror(repo_url, mirrors_dir):
+    """Create or update the mirror of a repository.
+
+    Fetches the latest commit of the default branch of the remote repository
+    and its trees, but no file contents (which needs a server that supports
+    partial clones; Github does).
+
+    Returns the pathname of the mirror.
+    """
+    mirror_dir = get_mirror_dir(repo_url, mirrors_dir)
+    if not os.path.isdir(mirror_dir):
+        os.makedirs(os.path.dirname(mirror_dir), exist_ok=True)
+        git('init', '--quiet', '--bare', mirror_dir)
+        git('remote', 'add', 'origin', repo_url, git_dir=mirror_dir)
+    git('fetch', '--quiet', '--depth=1', '--filter=blob:none', 'origin',
+        '+HEAD:' + MIRROR_REF, git_dir=mirror_dir)
+    return mirror_dir
+
+
+def list_files(mirror_dir, filenames):
+    """Check which of the given files exist in the mirrored HEAD.
+
+    Doesn't need to talk to the remote repository.
+
+    Returns a set of file names.
+    """
+    output = git('ls-tree', '--name-only', '-z', MIRROR_REF, '--',
+                 *filenames, git_dir=mirror_dir)
+    return set(output.decode('UTF-8').split('\0')) - {''}
+
+
+def read_file(mirror_dir, filename):
+    """Read a file from the mirrored HEAD.
+
+    Fetches the contents from the remote repository if necessary.
+
+    Returns bytes.
+    """
+    return git('cat-file', 'blob', '{}:{}'.format(MIRROR_REF, filename),
+               git_dir=mirror_dir)
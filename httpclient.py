@@ -0,0 +1,177 @@
+"""A small HTTP client with persistent connections.
+
+Used by the scripts that talk to PyPI and Github.  Unlike
+urllib.request.urlopen(), which opens a new connection (with a new TLS
+handshake) for every request, this keeps idle connections around and reuses
+them for subsequent requests to the same host.  It also asks for gzip
+compression, which makes a big difference for PyPI's JSON documents.
+
+This module requires Python 3.
+"""
+
+import contextlib
+import gzip
+import http.client
+import io
+import json
+import threading
+import urllib.error
+from collections import defaultdict
+from urllib.parse import urljoin, urlsplit
+
+
+class Error(Exception):
+    """An error that is not a bug in this script."""
+
+
+USER_AGENT = 'ztk-py3-status (https://github.com/mgedmin/ztk-py3-status)'
+
+# JSON is UTF-8 unless it says otherwise, so PyPI's bare application/json is
+# fine, but some callers insist on an explicit charset.
+UTF8_JSON_CONTENT_TYPES = ('application/json; charset="utf-8"',
+                           'application/json; charset=utf-8')
+JSON_CONTENT_TYPES = UTF8_JSON_CONTENT_TYPES + ('application/json', )
+
+REDIRECT_CODES = {301, 302, 303, 307, 308}
+
+
+class ConnectionPool(object):
+    """A pool of keep-alive HTTP and HTTPS connections.
+
+    Connections are kept per (scheme, host, port).  A connection is used by
+    one request at a time, so it's safe to share a pool between threads.
+    """
+
+    def __init__(self, timeout=60, max_redirects=5):
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.connections_made = 0
+        self._idle = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def _get_connection(self, key):
+        """Return an idle connection or make a new one.
+
+        Returns a tuple (connection, reused).
+        """
+        with self._lock:
+            if self._idle[key]:
+                return self._idle[key].pop(), True
+            self.connections_made += 1
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port,
+                                               timeout=self.timeout)
+        elif scheme == 'http':
+            conn = http.client.HTTPConnection(host, port,
+                                              timeout=self.timeout)
+        else:
+            raise Error('Unsupported URL scheme: {}'.format(scheme))
+        return conn, False
+
+    def _release(self, key, conn, response):
+        """Return a connection to the pool, if it can be reused."""
+        if response.isclosed() and not response.will_close:
+            with self._lock:
+                self._idle[key].append(conn)
+        else:
+            # The body wasn't read to the end or the server doesn't want to
+            # keep the connection open.
+            conn.close()
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            for connections in self._idle.values():
+                for conn in connections:
+                    conn.close()
+            self._idle.clear()
+
+    def _request(self, url, headers):
+        """Send a GET request for a URL.
+
+        Returns a tuple (key, connection, response).
+        """
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        while True:
+            conn, reused = self._get_connection(key)
+            try:
+                conn.request('GET', path, headers=headers)
+                return key, conn, conn.getresponse()
+            except ConnectionError:
+                conn.close()
+                # The server may have closed an idle connection while we
+                # weren't looking; try again with a fresh one.
+                if not reused:
+                    raise
+            except Exception:
+                conn.close()
+                raise
+
+    @contextlib.contextmanager
+    def open(self, url, headers=None):
+        """Perform an HTTP GET request for a URL, following redirects.
+
+        Returns a context manager that yields an http.client.HTTPResponse.
+        Read the response body to the end if you want the connection to be
+        reused.
+
+        Raises urllib.error.HTTPError for error responses (including 304 Not
+        Modified), just like urllib.request.urlopen() does.
+        """
+        request_headers = {'User-Agent': USER_AGENT}
+        request_headers.update(headers or {})
+        for _ in range(self.max_redirects + 1):
+            key, conn, response = self._request(url, request_headers)
+            location = response.getheader('Location')
+            if response.status in REDIRECT_CODES and location:
+                response.read()
+                self._release(key, conn, response)
+                url = urljoin(url, location)
+                continue
+            if not 200 <= response.status < 300:
+                body = response.read()
+                self._release(key, conn, response)
+                raise urllib.error.HTTPError(url, response.status,
+                                             response.reason, response.msg,
+                                             io.BytesIO(body))
+            try:
+                yield response
+            finally:
+                self._release(key, conn, response)
+            return
+        raise Error('Too many redirects for {}'.format(url))
+
+
+default_pool = ConnectionPool()
+
+
+def get_json_and_headers(url, headers=None, pool=None,
+                         content_types=JSON_CONTENT_TYPES):
+    """Perform HTTP GET for a URL, return deserialized JSON and headers.
+
+    Raises Error if the response has a Content-Type that is not listed in
+    content_types.
+
+    Returns a tuple (json_data, headers) where headers is an instance
+    of email.message.Message (because that's what http.client gives us).
+    """
+    if pool is None:
+        pool = default_pool
+    request_headers = {'Accept': 'application/json',
+                       'Accept-Encoding': 'gzip'}
+    request_headers.update(headers or {})
+    with pool.open(url, request_headers) as r:
+        # We expect UTF-8, but let's verify that.
+        content_type = r.getheader('Content-Type', '').lower()
+        if content_type not in content_types:
+            raise Error('Did not get UTF-8 JSON data from {}, got {}'
+                        .format(url, content_type))
+        body = r
+        if r.getheader('Content-Encoding', '').lower() == 'gzip':
+            body = gzip.GzipFile(fileobj=r)
+        return json.load(body), r.msg
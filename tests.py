@@ -1,7 +1,34 @@
 #!/usr/bin/python3
+import concurrent.futures
+import contextlib
+import doctest
+import email
+import gzip
+import hashlib
+import http.server
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
 import unittest
+import unittest.mock
+import urllib.error
+import zipfile
+from io import BytesIO, StringIO
 
-from get_pypi_status import extract_py_versions
+import count_blockers
+import depgraph
+import get_deps
+import get_pypi_status
+import gitmirror
+import httpclient
+from checkpoint import Journal
+from get_pypi_status import TokenBucket, extract_py_versions
 
 class Tests(unittest.TestCase):
 
@@ -34,6 +61,1001 @@ class Tests(unittest.TestCase):
             "Programming Language :: Python :: 3",
         ]), ['2.7', '3'])
 
+    def test_token_bucket(self):
+        now = [100.0]
+        sleeps = []
+        bucket = TokenBucket(5, clock=lambda: now[0], sleep=sleeps.append)
+        bucket.acquire()
+        bucket.acquire()
+        bucket.acquire()
+        self.assertEqual(sleeps, [0.2, 0.4])
+        now[0] += 10
+        bucket.acquire()
+        self.assertEqual(sleeps, [0.2, 0.4])
+
+    def test_adaptive_rate_limiter(self):
+        now = [100.0]
+        sleeps = []
+        limiter = get_pypi_status.AdaptiveRateLimiter(
+            4, max_rate=5, clock=lambda: now[0], sleep=sleeps.append)
+        limiter.succeeded()
+        self.assertEqual(limiter.rate, 4.25)
+        for n in range(10):
+            limiter.succeeded()
+        self.assertEqual(limiter.rate, 5)
+        limiter.throttled(retry_after=2)
+        self.assertEqual(limiter.rate, 2.5)
+        limiter.acquire()
+        self.assertEqual(sleeps, [2.4])
+
+    def test_ratelimit_retries(self):
+        sleeps = []
+        errors = [(503, {'Retry-After': '7'}), (500, {})]
+        limiter = get_pypi_status.TokenBucket(1000)
+        limiter.pause = sleeps.append
+
+        @get_pypi_status.ratelimit(limiter, max_retries=2, backoff=1,
+                                   sleep=sleeps.append, jitter=lambda: 0.5)
+        def fn():
+            if errors:
+                code, headers = errors.pop(0)
+                raise urllib.error.HTTPError(
+                    'http://example.com', code, 'Oops',
+                    email.message_from_string(''.join(
+                        '{}: {}\n'.format(k, v)
+                        for k, v in headers.items()) + '\n'),
+                    StringIO())
+            return 'ok'
+
+        self.assertEqual(fn(), 'ok')
+        self.assertEqual(sleeps, [7, 2])
+        self.assertEqual(limiter.acquired, 3)
+
+    def test_retry_after_is_clamped(self):
+        def headers(value):
+            return email.message_from_string(
+                'Retry-After: {}\n\n'.format(value))
+        max_wait = get_pypi_status.MAX_RETRY_AFTER
+        parse_retry_after = get_pypi_status.parse_retry_after
+        self.assertEqual(parse_retry_after(headers('7')), 7)
+        self.assertEqual(parse_retry_after(headers('86400')), max_wait)
+        self.assertEqual(
+            parse_retry_after(headers('Fri, 31 Dec 2100 23:59:59 GMT')),
+            max_wait)
+        sleeps = []
+
+        @get_pypi_status.ratelimit(None, max_retries=1, sleep=sleeps.append)
+        def fn():
+            if not sleeps:
+                raise urllib.error.HTTPError(
+                    'http://example.com', 503, 'Oops',
+                    headers('999999999'), StringIO())
+            return 'ok'
+
+        self.assertEqual(fn(), 'ok')
+        self.assertEqual(sleeps, [max_wait])
+
+
+class MetadataCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp(prefix='test-cache-')
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        self.cache = self.make_cache()
+        self.addCleanup(self.cache.close)
+        self.requests = []
+        self.responses = []
+        real_get_json_and_headers = get_pypi_status.get_json_and_headers
+        get_pypi_status.get_json_and_headers = self.get_json_and_headers
+        self.addCleanup(setattr, get_pypi_status, 'get_json_and_headers',
+                        real_get_json_and_headers)
+
+    def get_json_and_headers(self, url, headers=None):
+        self.requests.append((url, headers))
+        status, data, response_headers = self.responses.pop(0)
+        response_headers = email.message_from_string(
+            ''.join('{}: {}\n'.format(k, v)
+                    for k, v in response_headers.items()) + '\n')
+        if status != 200:
+            raise urllib.error.HTTPError(url, status, 'Oops',
+                                         response_headers, StringIO())
+        return data, response_headers
+
+    def make_cache(self):
+        return get_pypi_status.DirectoryCache(self.cache_dir)
+
+    def make_stale(self, package_name):
+        entry, fetched = self.cache.get(package_name)
+        long_ago = time.time() - 2 * get_pypi_status.ONE_DAY
+        self.cache.put(package_name, entry['metadata'], entry['validators'],
+                       fetched=long_ago)
+
+    def test_revalidation(self):
+        metadata = {'info': {'version': '1.0', 'classifiers': [],
+                             'requires_dist': None},
+                    'urls': []}
+        self.responses.append((200, metadata, {'ETag': '"abc"'}))
+        self.assertEqual(
+            get_pypi_status.get_metadata('zope.foo', self.cache),
+            metadata)
+        self.assertEqual(self.requests[-1][1], {})
+        self.make_stale('zope.foo')
+        self.responses.append((304, None, {}))
+        self.assertEqual(
+            get_pypi_status.get_metadata('zope.foo', self.cache),
+            metadata)
+        self.assertEqual(self.requests[-1][1], {'If-None-Match': '"abc"'})
+        # the 304 made the cache entry fresh again
+        self.assertEqual(
+            get_pypi_status.get_metadata('zope.foo', self.cache),
+            metadata)
+        self.assertEqual(len(self.requests), 2)
+
+    def test_negative_cache(self):
+        ttl = get_pypi_status.ONE_DAY
+        for n in range(3):
+            self.responses.append((404, None, {}))
+            with self.assertRaises(urllib.error.HTTPError):
+                get_pypi_status.get_metadata('zope.foo', self.cache,
+                                             max_negative_ttl=3 * ttl)
+            with self.assertRaises(get_pypi_status.CachedNotFound):
+                get_pypi_status.get_metadata('zope.foo', self.cache)
+            entry, fetched = self.cache.get('zope.foo')
+            self.assertEqual(entry['ttl'], [ttl, 2 * ttl, 3 * ttl][n])
+            self.cache.put('zope.foo', {}, ttl=entry['ttl'],
+                           fetched=fetched - entry['ttl'] - 1)
+        self.assertEqual(len(self.requests), 3)
+
+    def test_negative_cache_strict_max_age(self):
+        long_ago = time.time() - 2 * 60 * 60
+        self.cache.put('zope.foo', {}, ttl=get_pypi_status.ONE_DAY,
+                       fetched=long_ago)
+        # the TTL wins over the default max age
+        with self.assertRaises(get_pypi_status.CachedNotFound):
+            get_pypi_status.get_metadata('zope.foo', self.cache, max_age=60)
+        self.assertFalse(get_pypi_status.needs_refresh(
+            'zope.foo', self.cache, 60))
+        # but not over one the user asked for
+        self.assertTrue(get_pypi_status.needs_refresh(
+            'zope.foo', self.cache, 60, strict_max_age=True))
+        self.responses.append((404, None, {}))
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            get_pypi_status.get_metadata('zope.foo', self.cache, max_age=60,
+                                         strict_max_age=True)
+        self.assertNotIsInstance(cm.exception,
+                                 get_pypi_status.CachedNotFound)
+        self.assertEqual(len(self.requests), 1)
+
+    def test_migrate_cache(self):
+        metadata = {
+            'info': {'version': '1.0', 'classifiers': [], 'summary': 'Foo'},
+            'last_serial': 42,
+            'releases': {'0.9': [], '1.0': []},
+            'urls': [
+                {'packagetype': 'bdist_wheel',
+                 'filename': 'zope.foo-1.0-cp311-cp311-linux_x86_64.whl',
+                 'url': 'zope.foo-1.0-cp311-cp311-linux_x86_64.whl'},
+                {'packagetype': 'bdist_wheel',
+                 'filename': 'zope.foo-1.0-py3-none-any.whl',
+                 'url': 'zope.foo-1.0-py3-none-any.whl'},
+                {'packagetype': 'sdist', 'url': 'zope.foo-1.0.tar.gz'},
+            ],
+        }
+        with open(os.path.join(self.cache_dir, 'zope.foo.json'), 'w') as f:
+            json.dump(metadata, f)
+        with open(os.path.join(self.cache_dir, 'zope.foo.validators'),
+                  'w') as f:
+            json.dump({'etag': '"abc"'}, f)
+        with open(os.path.join(self.cache_dir, 'zope.bar.json'), 'w') as f:
+            json.dump({}, f)
+        long_ago = time.time() - 2 * get_pypi_status.ONE_DAY
+        os.utime(os.path.join(self.cache_dir, 'zope.foo.json'),
+                 (long_ago, long_ago))
+        self.assertEqual(self.cache.migrate(), 2)
+        self.assertEqual(self.cache.migrate(), 0)
+        self.assertEqual(sorted(os.listdir(self.cache_dir)),
+                         ['zope.bar.json', 'zope.foo.json'])
+        self.assertIsNone(
+            get_pypi_status.get_cached_metadata('zope.foo', self.cache))
+        self.assertEqual(
+            get_pypi_status.get_cached_metadata(
+                'zope.foo', self.cache, get_pypi_status.UNLIMITED),
+            {'info': {'version': '1.0', 'classifiers': [],
+                      'requires_dist': None},
+             'last_serial': 42,
+             'urls': [{'packagetype': 'sdist',
+                       'url': 'zope.foo-1.0.tar.gz'},
+                      {'packagetype': 'bdist_wheel',
+                       'filename': 'zope.foo-1.0-py3-none-any.whl',
+                       'url': 'zope.foo-1.0-py3-none-any.whl'}]})
+        self.assertEqual(
+            get_pypi_status.get_cached_metadata('zope.bar', self.cache),
+            {})
+        self.make_stale('zope.foo')
+        self.responses.append((304, None, {}))
+        get_pypi_status.get_metadata('zope.foo', self.cache)
+        self.assertEqual(self.requests[-1][1], {'If-None-Match': '"abc"'})
+
+    def test_unusable_entries_are_refetched(self):
+        if not isinstance(self.cache, get_pypi_status.DirectoryCache):
+            self.skipTest('only directory caches have files to mangle')
+        metadata = {'info': {'version': '1.0', 'classifiers': [],
+                             'requires_dist': None},
+                    'urls': []}
+        junk = {'zope.foo': {'info': {'version': '0.9'}},
+                'zope.bar': ['not', 'a', 'dict'],
+                'zope.baz': {'schema': 2, 'metadata': {}}}
+        for name, data in junk.items():
+            with open(self.cache.get_filename(name), 'w') as f:
+                json.dump(data, f)
+        self.assertEqual(self.cache.migrate(), 0)
+        for name in junk:
+            self.assertEqual(self.cache.get(name), (None, None))
+            self.responses.append((200, metadata, {}))
+            self.assertEqual(get_pypi_status.get_metadata(name, self.cache),
+                             metadata)
+        self.assertEqual(len(self.requests), 3)
+
+    def test_plan_refresh(self):
+        changelog = FakeChangelog(serial=120, changes=[
+            ('zope.foo', '1.1', 1500000000, 'new release', 110),
+            ('Zope_Bar', '2.0', 1500000001, 'new release', 120),
+        ])
+        names = ['zope.foo', 'zope.bar', 'zope.baz']
+        self.assertEqual(get_pypi_status.plan_refresh(names, changelog, 100),
+                         ([0, 0, get_pypi_status.UNLIMITED], 120))
+
+    def test_stale_while_revalidate(self):
+        def metadata(version):
+            return {'info': {'version': version, 'classifiers': [],
+                             'requires_dist': None},
+                    'urls': []}
+        long_ago = time.time() - 2 * get_pypi_status.ONE_DAY
+        # stale: served from the cache, then refreshed
+        self.cache.put('zope.foo', metadata('1.0'), fetched=long_ago)
+        # fresh: never requested
+        self.cache.put('zope.bar', metadata('1.0'))
+        # failed: not cached, request fails, not retried in the same run
+        packages = [dict(name='zope.foo'), dict(name='zope.bar'),
+                    dict(name='zope.baz')]
+        self.responses += [(500, None, {}), (200, metadata('2.0'), {})]
+        output = os.path.join(self.cache_dir, 'status.json')
+        stderr = StringIO()
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            with contextlib.redirect_stderr(stderr):
+                serial = get_pypi_status.annotate_packages_stale(
+                    packages, [get_pypi_status.ONE_DAY] * 3,
+                    7 * get_pypi_status.ONE_DAY, output, self.cache,
+                    executor, serial=100)
+        self.assertEqual([url for url, headers in self.requests],
+                         [get_pypi_status.PYPI_SERVER + '/zope.baz/json',
+                          get_pypi_status.PYPI_SERVER + '/zope.foo/json'])
+        self.assertIn('Could not fetch metadata about zope.baz',
+                      stderr.getvalue())
+        self.assertIsNone(serial)
+        # the output was written before the refresh
+        with open(output) as f:
+            self.assertEqual([info['version'] for info in json.load(f)],
+                             ['1.0', '1.0', None])
+        self.assertEqual([info['version'] for info in packages],
+                         ['2.0', '1.0', None])
+        self.assertFalse([name for name in os.listdir(self.cache_dir)
+                          if name.startswith('.tmp-')])
+
+    def test_plan_refresh_first_run(self):
+        # Without a recorded serial we can't tell what changed since a
+        # cache entry was fetched, so nothing may come from the cache
+        # unchecked, or changes before serial 120 would never be seen.
+        changelog = FakeChangelog(serial=120, changes=[])
+        names = ['zope.foo', 'zope.bar']
+        self.assertEqual(get_pypi_status.plan_refresh(names, changelog, None),
+                         ([0, 0], 120))
+
+
+class SQLiteCacheTests(MetadataCacheTests):
+
+    def make_cache(self):
+        return get_pypi_status.SQLiteCache(
+            os.path.join(self.cache_dir, 'cache.db'))
+
+    def test_migrate_cache(self):
+        directory = get_pypi_status.DirectoryCache(self.cache_dir)
+        directory.put('zope.foo', {'info': {}}, fetched=1000000000)
+        directory.put('zope.bar', {})
+        self.assertEqual(self.cache.import_from(directory), 2)
+        self.assertEqual(self.cache.names(), ['zope.bar', 'zope.foo'])
+        self.assertEqual(self.cache.get('zope.foo'),
+                         ({'schema': get_pypi_status.CACHE_SCHEMA,
+                           'metadata': {'info': {}},
+                           'validators': {}}, 1000000000))
+        self.assertEqual(
+            get_pypi_status.get_cached_metadata('zope.bar', self.cache), {})
+
+
+class JournalTests(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp(prefix='test-journal-')
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.filename = os.path.join(tmpdir, 'journal')
+
+    def test_resume(self):
+        journal = Journal(self.filename)
+        journal.add({'name': 'zope.foo', 'version': '1.0'})
+        journal.add({'name': 'zope.bar', 'version': '2.0'})
+        journal.add({'name': 'zope.foo', 'version': '1.1'})
+        journal.close()
+        with open(self.filename, 'a') as f:
+            f.write('{"name": "zope.baz", "ver')
+        journal = Journal(self.filename, resume=True)
+        self.assertEqual(len(journal), 2)
+        self.assertEqual(journal.get('zope.foo'),
+                         {'name': 'zope.foo', 'version': '1.1'})
+        self.assertNotIn('zope.baz', journal)
+        journal.add({'name': 'zope.baz', 'version': '3.0'})
+        journal.close()
+        journal = Journal(self.filename, resume=True)
+        self.assertEqual(len(journal), 3)
+        journal.close(remove=True)
+        self.assertFalse(os.path.exists(self.filename))
+        journal = Journal(self.filename)
+        self.assertEqual(len(journal), 0)
+        journal.close()
+
+
+class FakeChangelog(object):
+
+    def __init__(self, serial, changes):
+        self.serial = serial
+        self.changes = changes
+
+    def last_serial(self):
+        return self.serial
+
+    def changed_since(self, serial):
+        changes = [c for c in self.changes if c[4] > serial]
+        return ({get_pypi_status.canonical_name(c[0]) for c in changes},
+                max([c[4] for c in changes], default=serial))
+
+
+class JSONRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/missing':
+            self.send_error(404)
+            return
+        if self.path == '/old':
+            self.send_response(301)
+            self.send_header('Location', '/data')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = json.dumps({'path': self.path}).encode('UTF-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class HTTPClientTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                      JSONRequestHandler)
+        self.addCleanup(self.server.server_close)
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  kwargs=dict(poll_interval=0.01))
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.pool = httpclient.ConnectionPool(timeout=5)
+        self.addCleanup(self.pool.close)
+
+    def test_get_json_reuses_connections(self):
+        for path in ['/a', '/b', '/old']:
+            data, headers = httpclient.get_json_and_headers(
+                self.url + path, pool=self.pool)
+            self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(data, {'path': '/data'})
+        self.assertEqual(self.pool.connections_made, 1)
+
+    def test_get_json_content_types(self):
+        data, headers = httpclient.get_json_and_headers(self.url + '/a',
+                                                        pool=self.pool)
+        self.assertEqual(data, {'path': '/a'})
+        with self.assertRaises(httpclient.Error):
+            httpclient.get_json_and_headers(
+                self.url + '/a', pool=self.pool,
+                content_types=httpclient.UTF8_JSON_CONTENT_TYPES)
+
+    def test_get_json_error(self):
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            httpclient.get_json_and_headers(self.url + '/missing',
+                                            pool=self.pool)
+        self.assertEqual(cm.exception.code, 404)
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    files = {}
+    supports_ranges = True
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('Range')))
+        body = self.files.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        start, end = 0, len(body) - 1
+        range_header = self.headers.get('Range')
+        if range_header and self.supports_ranges:
+            first, _, last = range_header[len('bytes='):].partition('-')
+            if first:
+                start = int(first)
+                end = min(int(last), end) if last else end
+            else:
+                start = max(0, len(body) - int(last))
+            if start > end:
+                self.send_response(416)
+                self.send_header('Content-Range',
+                                 'bytes */{}'.format(len(body)))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, end, len(body)))
+        else:
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        self.wfile.write(body[start:end + 1])
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadTests(unittest.TestCase):
+
+    handler = RangeRequestHandler
+
+    def setUp(self):
+        self.handler = type('Handler', (self.handler, ), dict(files={}))
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                      self.handler)
+        self.server.requests = []
+        self.addCleanup(self.server.server_close)
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  kwargs=dict(poll_interval=0.01))
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.pool = httpclient.ConnectionPool(timeout=5)
+        self.addCleanup(self.pool.close)
+        self.tmpdir = tempfile.mkdtemp(prefix='test-download-')
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_download_resumes(self):
+        data = b'zope.foo-1.0.tar.gz contents' * 100
+        self.handler.files['/zope.foo-1.0.tar.gz'] = data
+        filename = os.path.join(self.tmpdir, 'zope.foo-1.0.tar.gz')
+        with open(filename + '.part', 'wb') as f:
+            f.write(data[:1000])
+        get_deps.download(self.url + '/zope.foo-1.0.tar.gz', filename,
+                          hashlib.sha256(data).hexdigest(), pool=self.pool)
+        with open(filename, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        self.assertFalse(os.path.exists(filename + '.part'))
+        self.assertEqual(self.server.requests,
+                         [('/zope.foo-1.0.tar.gz', 'bytes=1000-')])
+
+    def test_download_without_range_support(self):
+        self.handler.supports_ranges = False
+        data = b'zope.foo-1.0.tar.gz contents' * 100
+        self.handler.files['/zope.foo-1.0.tar.gz'] = data
+        filename = os.path.join(self.tmpdir, 'zope.foo-1.0.tar.gz')
+        with open(filename + '.part', 'wb') as f:
+            f.write(b'garbage')
+        get_deps.download(self.url + '/zope.foo-1.0.tar.gz', filename,
+                          pool=self.pool)
+        with open(filename, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_download_checksum_mismatch(self):
+        self.handler.files['/zope.foo-1.0.tar.gz'] = b'corrupted'
+        filename = os.path.join(self.tmpdir, 'zope.foo-1.0.tar.gz')
+        with self.assertRaises(get_deps.Error):
+            get_deps.download(self.url + '/zope.foo-1.0.tar.gz', filename,
+                              hashlib.sha256(b'data').hexdigest(),
+                              pool=self.pool)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def make_wheel(self):
+        data = BytesIO()
+        with zipfile.ZipFile(data, 'w', zipfile.ZIP_DEFLATED) as f:
+            # incompressible, so the wheel is bigger than one Range request
+            f.writestr('zope/foo/big.dat', os.urandom(200 * 1024))
+            f.writestr('zope.foo-1.0.dist-info/METADATA',
+                       'Metadata-Version: 2.1\n'
+                       'Name: zope.foo\n'
+                       'Requires-Dist: zope.interface\n'
+                       'Requires-Dist: zope.testing ; extra == "test"\n')
+        return data.getvalue()
+
+    def test_read_wheel_requirements(self):
+        self.handler.files['/zope.foo-1.0-py3-none-any.whl'] = \
+            self.make_wheel()
+        self.assertEqual(
+            get_deps.read_wheel_requirements(
+                self.url + '/zope.foo-1.0-py3-none-any.whl', pool=self.pool),
+            (['zope.interface'], {'test': ['zope.testing']}))
+        self.assertEqual(self.server.requests,
+                         [('/zope.foo-1.0-py3-none-any.whl', 'bytes=-65536')])
+
+    def test_remote_file_reads_ranges(self):
+        data = bytes(range(256)) * 10
+        self.handler.files['/data'] = data
+        f = get_deps.RemoteFile(self.url + '/data', pool=self.pool,
+                                block_size=1000)
+        f.seek(100)
+        self.assertEqual(f.read(10), data[100:110])
+        self.assertEqual(f.read(10), data[110:120])
+        f.seek(-10, os.SEEK_END)
+        self.assertEqual(f.read(), data[-10:])
+        self.assertEqual(self.server.requests,
+                         [('/data', 'bytes=-1000'),
+                          ('/data', 'bytes=100-1099')])
+
+    def test_remote_file_reads_at_eof(self):
+        data = bytes(range(256)) * 10
+        self.handler.files['/data'] = data
+        f = get_deps.RemoteFile(self.url + '/data', pool=self.pool,
+                                block_size=1000)
+        f.seek(0, os.SEEK_END)
+        self.assertEqual(f.read(), b'')
+        self.assertEqual(f.read(10), b'')
+        f.seek(100, os.SEEK_END)
+        self.assertEqual(f.read(10), b'')
+        f.seek(0)
+        self.assertEqual(f.read(0), b'')
+        self.assertEqual(self.server.requests, [('/data', 'bytes=-1000')])
+
+    def test_read_wheel_requirements_without_range_support(self):
+        self.handler.supports_ranges = False
+        self.handler.files['/zope.foo-1.0-py3-none-any.whl'] = \
+            self.make_wheel()
+        self.assertEqual(
+            get_deps.read_wheel_requirements(
+                self.url + '/zope.foo-1.0-py3-none-any.whl', pool=self.pool),
+            (['zope.interface'], {'test': ['zope.testing']}))
+        self.assertEqual(len(self.server.requests), 1)
+
+
+class SdistTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='test-sdist-')
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def make_tar(self, basename, files):
+        filename = os.path.join(self.tmpdir, basename)
+        with tarfile.open(filename, 'w:' + basename.rpartition('.')[-1]) as f:
+            for name, data in files.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                f.addfile(info, BytesIO(data))
+        return filename
+
+    def test_requires_txt(self):
+        filename = self.make_tar('zope.foo-1.0.tar.xz', {
+            'zope.foo-1.0/PKG-INFO': b'Metadata-Version: 1.1\n',
+            'zope.foo-1.0/src/zope.foo.egg-info/requires.txt':
+                b'zope.interface\n\n[test]\nzope.testing\n',
+        })
+        self.assertEqual(get_deps.extract_requirements(filename),
+                         b'zope.interface\n\n[test]\nzope.testing\n')
+
+    def test_requirements_from_pkg_info(self):
+        filename = self.make_tar('zope.foo-1.0.tar.gz', {
+            'zope.foo-1.0/PKG-INFO': (
+                b'Metadata-Version: 2.1\n'
+                b'Name: zope.foo\n'
+                b'Requires-Dist: zope.interface (>=5)\n'
+                b'Requires-Dist: zope.testing; extra == "test"\n'),
+            'zope.foo-1.0/src/zope.foo.egg-info/requires.txt': b'bogus\n',
+        })
+        self.assertEqual(get_deps.extract_requirements(filename),
+                         b'zope.interface\n\n[test]\nzope.testing\n')
+
+    def test_parse_workers(self):
+        cache_dir = os.path.join(self.tmpdir, 'cache')
+        os.mkdir(cache_dir)
+        packages = []
+        for n in range(4):
+            basename = 'zope.foo{}-1.0.tar.gz'.format(n)
+            self.make_tar(basename, {
+                'zope.foo{}-1.0/zope.foo{}.egg-info/requires.txt'.format(n, n):
+                    'zope.bar{}\n'.format(n).encode(),
+            })
+            os.rename(os.path.join(self.tmpdir, basename),
+                      os.path.join(cache_dir, basename))
+            packages.append(dict(
+                name='zope.foo{}'.format(n),
+                sdist_url='https://example.com/' + basename))
+        output = os.path.join(self.tmpdir, 'deps.json')
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'get_deps.py')
+        subprocess.run(
+            [sys.executable, script, '--cache-dir', cache_dir,
+             '--parse-workers=2', '--jobs=2', '-o', output,
+             '--journal', os.path.join(self.tmpdir, 'journal')],
+            input=json.dumps(packages).encode(), check=True, timeout=60)
+        with open(output) as f:
+            self.assertEqual([info['requires'] for info in json.load(f)],
+                             [['zope.bar0'], ['zope.bar1'], ['zope.bar2'],
+                              ['zope.bar3']])
+
+    def test_requirements_index(self):
+        filename = self.make_tar('zope.foo-1.0.tar.gz', {})
+        index_filename = os.path.join(self.tmpdir, 'index.json')
+        index = get_deps.RequirementsIndex(index_filename)
+        self.assertIsNone(index.get(filename))
+        index.put(filename, ['zope.interface'], {'test': ['zope.testing']})
+        index.save()
+        index = get_deps.RequirementsIndex(index_filename)
+        self.assertEqual(index.get(filename),
+                         (['zope.interface'], {'test': ['zope.testing']}))
+        os.utime(filename, (0, 0))
+        self.assertIsNone(index.get(filename))
+
+    def test_evict_from_cache(self):
+        for n, name in enumerate(['a-1.0.tar.gz', 'b-1.0.zip', 'c-1.0.tar.gz',
+                                  'd-1.0.tar.gz.part', 'e-1.0.egg']):
+            with open(os.path.join(self.tmpdir, name), 'wb') as f:
+                f.write(b'x' * 100)
+            os.utime(os.path.join(self.tmpdir, name), (n, n))
+        access_index = get_deps.AccessIndex(
+            os.path.join(self.tmpdir, 'no-such-index.json'))
+        access_index.touch(os.path.join(self.tmpdir, 'a-1.0.tar.gz'))
+        self.assertEqual(
+            get_deps.evict_from_cache(self.tmpdir, 250, {'b-1.0.zip'},
+                                      access_index),
+            (200, ['c-1.0.tar.gz', 'd-1.0.tar.gz.part']))
+        # the egg doesn't count
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ['a-1.0.tar.gz', 'b-1.0.zip', 'e-1.0.egg'])
+
+
+class GitMirrorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='test-git-')
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.work_dir = os.path.join(self.tmpdir, 'work')
+        self.repo_dir = os.path.join(self.tmpdir, 'zope.foo.git')
+        self.repo_url = 'file://' + self.repo_dir
+        self.mirrors_dir = os.path.join(self.tmpdir, 'mirrors')
+        gitmirror.git('init', '--quiet', self.work_dir)
+        gitmirror.git('init', '--quiet', '--bare', self.repo_dir)
+        gitmirror.git('config', 'uploadpack.allowFilter', 'true',
+                      git_dir=self.repo_dir)
+        gitmirror.git('symbolic-ref', 'HEAD', 'refs/heads/master',
+                      git_dir=self.repo_dir)
+
+    def commit(self, files):
+        for filename, text in files.items():
+            with open(os.path.join(self.work_dir, filename), 'w') as f:
+                f.write(text)
+        work = os.path.join(self.work_dir, '.git')
+        gitmirror.git('--work-tree', self.work_dir, 'add', '.', git_dir=work)
+        gitmirror.git('-c', 'user.name=Test', '-c', 'user.email=test@example',
+                      '--work-tree', self.work_dir, 'commit', '--quiet',
+                      '-m', 'Update', git_dir=work)
+        gitmirror.git('push', '--quiet', self.repo_url, 'HEAD:master',
+                      git_dir=work)
+
+    def test_setup_py(self):
+        self.commit({'setup.py': (
+            'from setuptools import setup\n'
+            'TESTS_REQUIRE = ["zope.testing"]\n'
+            'setup(name="zope.foo",\n'
+            '      install_requires=["setuptools", "zope.interface >= 4"],\n'
+            '      extras_require=dict(test=TESTS_REQUIRE + ["mock"]))\n'
+        ), 'README.rst': 'Not needed\n'})
+        self.assertEqual(
+            get_deps.read_git_requirements(self.repo_url, self.mirrors_dir),
+            (['setuptools', 'zope.interface'],
+             {'test': ['zope.testing', 'mock']}))
+        mirror_dir = gitmirror.get_mirror_dir(self.repo_url, self.mirrors_dir)
+        missing = gitmirror.git('rev-list', '--objects', '--missing=print',
+                                gitmirror.MIRROR_REF, git_dir=mirror_dir)
+        # README.rst was never fetched
+        self.assertEqual(missing.count(b'?'), 1)
+
+    def test_update(self):
+        self.commit({'setup.py': 'from setuptools import setup\nsetup()\n'})
+        self.assertEqual(
+            get_deps.read_git_requirements(self.repo_url, self.mirrors_dir),
+            ([], {}))
+        self.commit({'setup.cfg': (
+            '[options]\n'
+            'install_requires =\n'
+            '    zope.interface\n'
+        )})
+        self.assertEqual(
+            get_deps.read_git_requirements(self.repo_url, self.mirrors_dir),
+            (['zope.interface'], {}))
+
+
+class CountBlockersTests(unittest.TestCase):
+
+    def test_add_transitive_blockers(self):
+        packages = [
+            dict(name='a', supports_py3=False, blockers=['b']),
+            dict(name='b', supports_py3=False, blockers=['c']),
+            dict(name='c', supports_py3=False, blockers=['b', 'd']),
+            dict(name='d', supports_py3=False, blockers=[]),
+            dict(name='e', supports_py3=False, blockers=['d']),
+            dict(name='f', supports_py3=True, blockers=[]),
+        ]
+        count_blockers.add_transitive_blockers(packages)
+        info = {p['name']: p for p in packages}
+        self.assertEqual(info['a']['transitive_blockers'], ['b', 'c', 'd'])
+        self.assertEqual(info['b']['transitive_blockers'], ['c', 'd'])
+        self.assertEqual(info['d']['transitive_blockers'], [])
+        self.assertEqual(
+            [info[n]['transitive_blocks_count'] for n in 'abcdef'],
+            [0, 2, 2, 4, 0, 0])
+        self.assertEqual([info[n]['porting_level'] for n in 'abcdef'],
+                         [3, 2, 2, 1, 2, 0])
+        # c, not b, is the one blocked by d
+        self.assertEqual(info['a']['critical_path'], ['a', 'b', 'c', 'd'])
+        self.assertEqual(info['c']['critical_path'], ['c', 'd'])
+        self.assertEqual(info['b']['blocker_cycle'], ['b', 'c'])
+        self.assertEqual(info['a']['blocker_cycle'], [])
+
+    def test_critical_path_through_cycle(self):
+        packages = [
+            dict(name='a', supports_py3=False, blockers=['b']),
+            dict(name='b', supports_py3=False, blockers=['c']),
+            dict(name='c', supports_py3=False, blockers=['d', 'e']),
+            dict(name='d', supports_py3=False, blockers=['b']),
+            dict(name='e', supports_py3=False, blockers=['f']),
+            dict(name='f', supports_py3=False, blockers=[]),
+        ]
+        count_blockers.add_transitive_blockers(packages)
+        info = {p['name']: p for p in packages}
+        self.assertEqual(info['b']['blocker_cycle'], ['b', 'c', 'd'])
+        self.assertEqual(info['a']['critical_path'],
+                         ['a', 'b', 'c', 'e', 'f'])
+        self.assertEqual(info['d']['critical_path'],
+                         ['d', 'b', 'c', 'e', 'f'])
+        self.assertEqual([info[n]['porting_level'] for n in 'abcdef'],
+                         [4, 3, 3, 3, 2, 1])
+
+    def test_reachability_index(self):
+        index = count_blockers.ReachabilityIndex.build({
+            'a': ['b', 'e'],
+            'b': ['c'],
+            'c': ['b', 'd'],
+            'e': ['d'],
+        })
+        self.assertEqual(index.dependencies('a'), ['b', 'c', 'd', 'e'])
+        self.assertEqual(index.dependencies('b'), ['c', 'd'])
+        self.assertEqual(index.dependents('d'), ['a', 'b', 'c', 'e'])
+        self.assertEqual(index.dependents('b'), ['a', 'c'])
+        self.assertEqual(index.count_dependents('d'), 4)
+        self.assertEqual(index.common_dependents('c', 'e'), ['a'])
+        filename = os.path.join(tempfile.mkdtemp(prefix='test-index-'),
+                                'reachability.json')
+        self.addCleanup(shutil.rmtree, os.path.dirname(filename))
+        index.save(filename)
+        index = count_blockers.ReachabilityIndex.load(filename)
+        self.assertEqual(index.dependents('b'), ['a', 'c'])
+
+
+class GraphTests(unittest.TestCase):
+
+    graph_class = depgraph.Graph
+
+    packages = [
+        dict(name='a', supports_py3=True, requires=['b', 'setuptools'],
+             requires_extras={'test': ['c[x]']}),
+        dict(name='b', supports_py3=False, requires=['c'],
+             requires_extras={}),
+        dict(name='c', supports_py3=None, requires=['b'],
+             requires_extras={'x': ['d']}),
+    ]
+
+    def make_graph(self, explicit_extras=False):
+        return depgraph.package_graph(self.packages, explicit_extras,
+                                      self.graph_class)
+
+    def test_package_graph(self):
+        graph = self.make_graph()
+        self.assertEqual(graph.nodes, ['a', 'b', 'c'])
+        self.assertEqual(graph.ghost_nodes, ['c[x]', 'd', 'setuptools'])
+        self.assertEqual(graph.edges('a'), ['b', 'c[x]', 'setuptools'])
+        self.assertEqual(graph.edges('c[x]'), ['c'])
+        self.assertEqual(graph.edges('nosuch'), [])
+        self.assertTrue(graph.has_edge('c', 'd'))
+        self.assertFalse(graph.has_edge('d', 'c'))
+        self.assertEqual(graph.edge_attrs('a', 'c[x]').get('extra'), 'test')
+        self.assertTrue(graph.edge_attrs('c[x]', 'c').get('tight'))
+        self.assertIsNone(graph.node_attrs('c').get('supports_py3', True))
+        self.assertTrue(graph.node_attrs('d').get('supports_py3', True))
+        self.assertIn('a', graph)
+        self.assertNotIn('d', graph)
+
+    def test_remove_edges(self):
+        graph = self.make_graph()
+        graph.remove_edges_to('setuptools')
+        self.assertEqual(graph.edges('a'), ['b', 'c[x]'])
+        self.assertEqual(graph.ghost_nodes, ['c[x]', 'd'])
+        graph.remove_edges_with_attr('extra')
+        self.assertEqual(graph.edges('a'), ['b'])
+        self.assertEqual(graph.edges('c'), ['b'])
+
+    def test_traversal(self):
+        graph = self.make_graph()
+        self.assertEqual(graph.transitive_closure(['b', 'nosuch']),
+                         {'b', 'c', 'd', 'nosuch'})
+        self.assertEqual(list(graph.traverse('b')), ['b', 'c', 'd'])
+        self.assertEqual(list(graph.traverse_edges('b')),
+                         [('b', 'c'), ('c', 'b'), ('c', 'd')])
+        rdeps = graph.transposed()
+        self.assertEqual(sorted(rdeps.traverse('d')),
+                         ['a', 'b', 'c', 'c[x]', 'd'])
+        self.assertEqual(rdeps.edges('c'), ['b', 'c[x]'])
+        self.assertEqual(rdeps.edge_attrs('d', 'c').get('extra'), 'x')
+
+    def test_traversal_limits(self):
+        graph = self.graph_class()
+        for src, dst in [('a', 'b'), ('a', 'c'), ('b', 'd'), ('c', 'd'),
+                         ('d', 'e')]:
+            graph.add_edge(src, dst)
+        self.assertEqual(list(graph.traverse('a')), ['a', 'b', 'd', 'e', 'c'])
+        self.assertEqual(list(graph.traverse('a', max_depth=1)),
+                         ['a', 'b', 'c'])
+        self.assertEqual(list(graph.traverse_edges('a', max_depth=2)),
+                         [('a', 'b'), ('b', 'd'), ('a', 'c'), ('c', 'd')])
+        predecessors = {}
+        self.assertEqual(list(graph.traverse('a', predecessors=predecessors,
+                                             breadth_first=True)),
+                         ['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(depgraph.path_to(predecessors, 'e'),
+                         ['a', 'b', 'd', 'e'])
+
+    def test_depth_limit_shorter_path_found_later(self):
+        graph = self.graph_class()
+        for src, dst in [('a', 'b'), ('b', 'c'), ('c', 'd'), ('a', 'c')]:
+            graph.add_edge(src, dst)
+        self.assertEqual(list(graph.traverse('a', max_depth=2)),
+                         ['a', 'b', 'c', 'd'])
+        self.assertEqual(list(graph.traverse('a', max_depth=2,
+                                             breadth_first=True)),
+                         ['a', 'b', 'c', 'd'])
+        self.assertEqual(list(graph.traverse_edges('a', max_depth=2)),
+                         [('a', 'b'), ('b', 'c'), ('a', 'c'), ('c', 'd')])
+
+    def test_extras_closure(self):
+        graph = self.make_graph(explicit_extras=True)
+        for node in graph.ghost_nodes:
+            graph.add_node(node)
+        self.assertEqual(graph.edges('a[test]'), ['a', 'c[x]'])
+        self.assertEqual(depgraph.extras_closure(graph, ['b', 'nosuch']),
+                         {'b', 'c', 'c[x]', 'd'})
+        self.assertEqual(depgraph.extras_closure(graph, ['a']),
+                         {'a', 'a[test]', 'b', 'c', 'c[x]', 'd', 'setuptools'})
+
+    def test_deep_traversal(self):
+        graph = self.graph_class()
+        for n in range(5000):
+            graph.add_edge(n, n + 1)
+        self.assertEqual(len(list(graph.traverse(0))), 5001)
+
+    def test_redundant_edges(self):
+        graph = self.make_graph()
+        graph.add_edge('a', 'c')
+        graph.add_edge('a', 'd')
+        edges = [(src, dst) for src in graph.nodes + graph.ghost_nodes
+                 for dst in graph.edges(src)]
+        self.assertEqual(depgraph.redundant_edges(edges),
+                         {('a', 'b'), ('a', 'c'), ('a', 'd')})
+        self.assertEqual(depgraph.redundant_edges([]), set())
+
+    def test_main_reduce(self):
+        tmpdir = tempfile.mkdtemp(prefix='test-depgraph-')
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, 'blockers.json')
+        with open(filename, 'w') as f:
+            json.dump([
+                dict(name='a', supports_py3=False, requires=['b', 'c'],
+                     requires_extras={}),
+                dict(name='b', supports_py3=False, requires=['c'],
+                     requires_extras={}),
+                dict(name='c', supports_py3=False, requires=[],
+                     requires_extras={}),
+                dict(name='d', supports_py3=False, requires=['a', 'c'],
+                     requires_extras={}),
+            ], f)
+
+        def run(*args):
+            argv = ['depgraph.py', '-i', filename, '--reduce'] + list(args)
+            if self.graph_class is depgraph.CompactGraph:
+                argv.append('--compact')
+            stdout, stderr = StringIO(), StringIO()
+            with unittest.mock.patch('sys.argv', argv), \
+                    contextlib.redirect_stdout(stdout), \
+                    contextlib.redirect_stderr(stderr):
+                depgraph.main()
+            edges = [line.split('[')[0].strip()
+                     for line in stdout.getvalue().splitlines()
+                     if ' -> ' in line]
+            return edges, stderr.getvalue()
+
+        edges, messages = run()
+        self.assertEqual(edges, ['"a" -> "b"', '"b" -> "c"', '"d" -> "a"'])
+        self.assertEqual(messages, 'depgraph.py: removed 2 of 5 edges\n')
+        # a -> c is redundant, but it's part of why a needs c
+        edges, messages = run('--why', 'c')
+        self.assertIn('"a" -> "c"', edges)
+        self.assertIn('"d" -> "c"', edges)
+        self.assertEqual(messages, 'depgraph.py: removed 0 of 5 edges\n')
+
+
+class CompactGraphTests(GraphTests):
+
+    graph_class = depgraph.CompactGraph
+
+
+class MemoizedGraphTests(unittest.TestCase):
+
+    def test_cached_views_are_updated(self):
+        graph = depgraph.Graph()
+        graph.add_edge('a', 'b')
+        self.assertEqual(graph.edges('a'), ['b'])
+        self.assertIs(graph.edges('a'), graph.edges('a'))
+        version = graph.version
+        graph.add_edge('a', 'c')
+        self.assertGreater(graph.version, version)
+        self.assertEqual(graph.edges('a'), ['b', 'c'])
+        self.assertEqual(graph.ghost_nodes, ['a', 'b', 'c'])
+
+    def test_transposed_view(self):
+        graph = depgraph.Graph()
+        graph.add_edge('a', 'b', extra='test')
+        rdeps = graph.transposed()
+        self.assertEqual(rdeps.edges('b'), ['a'])
+        graph.add_edge('c', 'b')
+        self.assertEqual(rdeps.edges('b'), ['a', 'c'])
+        self.assertEqual(rdeps.edge_attrs('b', 'a'), {'extra': 'test'})
+        graph.remove_edges_to('b')
+        self.assertEqual(rdeps.edges('b'), [])
+        self.assertEqual(graph.edges('a'), [])
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(count_blockers))
+    tests.addTests(doctest.DocTestSuite(depgraph))
+    tests.addTests(doctest.DocTestSuite(get_deps))
+    tests.addTests(doctest.DocTestSuite(gitmirror))
+    return tests
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,10 +1,10 @@
 #!/bin/sh
 ./get_zope_packages.py > packages.json
 ./get_move_status.py < packages.json > move-status.json
-./get_pypi_status.py < move-status.json > status.json
-##./get_deps.py --cache-dir=~/.buildout/cache/dist < status.json > deps.json
-./get_deps.py < status.json > deps.json
-./count_blockers.py < deps.json > blockers.json
+./get_pypi_status.py -o status.json < move-status.json
+##./get_deps.py --cache-dir=~/.buildout/cache/dist -o deps.json < status.json
+./get_deps.py -o deps.json < status.json
+./count_blockers.py --reachability-index=reachability.json < deps.json > blockers.json
 ./depgraph.py < blockers.json > deps.dot
 # Now to produce PNG or SVG files, install graphviz and
 ##neato -Tsvg deps.dot > deps.svg